@@ -0,0 +1,96 @@
+"""
+Resolve logical image names through a generated alias index instead of symlinks
+"""
+
+import os
+import json
+from typing import Iterator, Optional
+from constants import OUTPUT_DIRECTORY
+from image_pipeline import image_path, image_paths
+from output import write_json
+
+ALIAS_INDEX_FILE = "image_aliases.json"
+ALIAS_DIRECTORIES = ["unformatted", "preview"]
+
+
+class AliasIndex:
+    """
+    The `images/unformatted` and `images/preview` trees without the symlinks.
+    `aliases` maps every name in those directories to the raw image it
+    shows, and `blobs` maps raw image paths that deduplication removed to
+    the blob holding their content, so every image resolves to a regular file.
+    """
+
+    def __init__(
+        self,
+        aliases: Optional[dict[str, dict[str, str]]] = None,
+        blobs: Optional[dict[str, str]] = None,
+        directory: str = OUTPUT_DIRECTORY,
+    ) -> None:
+        self.aliases = aliases or {directory: {} for directory in ALIAS_DIRECTORIES}
+        self.blobs = blobs or {}
+        self.directory = directory
+
+    @classmethod
+    def load(cls, directory: str = OUTPUT_DIRECTORY) -> "AliasIndex":
+        """Load `image_aliases.json`, or an empty index if none was written."""
+        try:
+            with open(os.path.join(directory, ALIAS_INDEX_FILE), encoding="utf-8") as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            return cls(directory=directory)
+        return cls(index["aliases"], index["blobs"], directory)
+
+    @staticmethod
+    def exists(directory: str = OUTPUT_DIRECTORY) -> bool:
+        return os.path.exists(os.path.join(directory, ALIAS_INDEX_FILE))
+
+    def save(self) -> None:
+        write_json(
+            ALIAS_INDEX_FILE,
+            {
+                "aliases": {
+                    directory: dict(sorted(aliases.items()))
+                    for directory, aliases in self.aliases.items()
+                },
+                "blobs": dict(sorted(self.blobs.items())),
+            },
+        )
+
+    def add(self, directory: str, alias: str, raw_name: str) -> None:
+        self.aliases[directory][alias] = raw_name
+
+    def resolve_raw(self, path: str) -> str:
+        """The file holding the raw image at `path`, relative to `directory`."""
+        # a raw image written since deduplication ran replaces its blob
+        if os.path.isfile(os.path.join(self.directory, path)):
+            return path
+        return self.blobs.get(path, path)
+
+    def resolve(
+        self,
+        name: str,
+        directory: str = "unformatted",
+        size: Optional[int] = None,
+        image_format: str = "png",
+    ) -> Optional[str]:
+        """
+        Path, relative to `directory`, of the file holding an image of
+        `name` in `directory`, or `None` if `name` has no alias.
+        """
+        raw_name = self.aliases[directory].get(name)
+        if raw_name is None:
+            return None
+        return self.resolve_raw(image_path("raw", raw_name, size, image_format))
+
+    def paths(self) -> Iterator[tuple[str, str]]:
+        """
+        (logical path, file path) of every image the symlink trees would
+        hold, relative to `directory`.
+        """
+        for directory, aliases in self.aliases.items():
+            for alias, raw_name in aliases.items():
+                for logical_path, raw_path in zip(
+                    image_paths(directory, alias), image_paths("raw", raw_name)
+                ):
+                    yield logical_path, self.resolve_raw(raw_path)
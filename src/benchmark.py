@@ -0,0 +1,335 @@
+"""
+Benchmark the metadata generation and pricing stages against recorded
+upstream fixtures, and fail on regressions against a stored baseline
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import tracemalloc
+import fetch
+import names
+import gen_item_metadata
+import gen_container_metadata
+import refresh_prices
+from typing import Any, Callable, NamedTuple
+from constants import (
+    CSGO_API_URL,
+    DEFAULT_ASSET_DOMAIN,
+    OUTPUT_DIRECTORY,
+    SKINPORT_ITEMS_URL,
+    VANILLA_KNIVES,
+)
+from output import atomic_write
+from markets import MARKETS, skinport_headers
+
+BENCHMARK_DIRECTORY = "benchmarks"
+FIXTURE_DIRECTORY = os.path.join(BENCHMARK_DIRECTORY, "fixtures")
+BASELINE_PATH = os.path.join(BENCHMARK_DIRECTORY, "baseline.json")
+FIXTURES = {
+    "all": f"{CSGO_API_URL}/all.json",
+    "skins": f"{CSGO_API_URL}/skins.json",
+    "crates": f"{CSGO_API_URL}/crates.json",
+    "skinport": SKINPORT_ITEMS_URL,
+}
+SCALES = [1, 10, 100]
+METRICS = ["seconds", "peak_memory", "output_bytes"]
+
+Fixtures = dict[str, Any]
+
+
+class Measurement(NamedTuple):
+    seconds: float
+    peak_memory: int
+    output_bytes: int
+
+
+def record_fixtures() -> None:
+    """Store the current upstream documents as the benchmark fixtures."""
+    os.makedirs(FIXTURE_DIRECTORY, exist_ok=True)
+    for name, url in FIXTURES.items():
+        headers = skinport_headers() if url == SKINPORT_ITEMS_URL else None
+        body = b"".join(fetch.upstream.stream_bytes(url, headers))
+        atomic_write(os.path.join(FIXTURE_DIRECTORY, f"{name}.json"), body)
+        logging.info(f"Recorded {name} ({len(body)} bytes)")
+
+
+def load_fixtures() -> Fixtures:
+    fixtures = {}
+    for name in FIXTURES:
+        with open(os.path.join(FIXTURE_DIRECTORY, f"{name}.json"), "rb") as f:
+            fixtures[name] = json.load(f)
+    return fixtures
+
+
+def scaled_name(name: str, copy: int) -> str:
+    """
+    Name of the `copy`-th synthetic copy of an item or container. The marker
+    goes right after the weapon (or `Sticker |`) so StatTrak, souvenir and
+    condition affixes keep working, and copies of one item in different
+    documents still share an unformatted name. Vanilla knives keep their name.
+    """
+    if copy == 0:
+        return name
+    weapon, separator, rest = name.partition(" | ")
+    if separator:
+        return f"{weapon} | x{copy} {rest}"
+    if name in VANILLA_KNIVES or name.rpartition(" (")[0] in VANILLA_KNIVES:
+        return name
+    return f"x{copy} {name}"
+
+
+def rename(datum: dict[str, Any], key: str, copy: int) -> dict[str, Any]:
+    return {**datum, key: scaled_name(datum[key], copy)}
+
+
+def scale_fixtures(fixtures: Fixtures, factor: int) -> Fixtures:
+    """
+    A synthetic catalogue `factor` times the size of the recorded one, made
+    of renamed copies of every item, container and Skinport listing.
+    """
+    copies = range(factor)
+    return {
+        "all": {
+            key if copy == 0 else f"{key}-x{copy}": rename(datum, "name", copy)
+            for copy in copies
+            for key, datum in fixtures["all"].items()
+        },
+        "skins": [
+            rename(datum, "name", copy)
+            for copy in copies
+            for datum in fixtures["skins"]
+        ],
+        "crates": [
+            {
+                **rename(datum, "name", copy),
+                "contains": [rename(item, "name", copy) for item in datum["contains"]],
+                "contains_rare": [
+                    rename(item, "name", copy) for item in datum["contains_rare"]
+                ],
+            }
+            for copy in copies
+            for datum in fixtures["crates"]
+        ],
+        "skinport": [
+            rename(datum, "market_hash_name", copy)
+            for copy in copies
+            for datum in fixtures["skinport"]
+        ],
+    }
+
+
+def create_stages(fixtures: Fixtures) -> list[tuple[str, Callable[[], None]]]:
+    """The benchmarked stages, in the order a build runs them."""
+    return [
+        (
+            "item_metadata",
+            lambda: gen_item_metadata.generate(
+                fixtures["all"].items(), DEFAULT_ASSET_DOMAIN
+            ),
+        ),
+        (
+            "container_metadata",
+            lambda: gen_container_metadata.generate(
+                fixtures["crates"],
+                gen_container_metadata.get_skin_float_ranges(fixtures["skins"]),
+                DEFAULT_ASSET_DOMAIN,
+            ),
+        ),
+        ("names", names.write_name_index),
+        (
+            "prices",
+            lambda: refresh_prices.refresh(
+                MARKETS["skinport"].to_frame(fixtures["skinport"])
+            ),
+        ),
+    ]
+
+
+def snapshot_output() -> dict[str, tuple[int, int]]:
+    """(modification time, size) of every file under `OUTPUT_DIRECTORY`."""
+    files = {}
+    for root, _, filenames in os.walk(OUTPUT_DIRECTORY):
+        for filename in filenames:
+            stat = os.stat(os.path.join(root, filename))
+            files[os.path.join(root, filename)] = (stat.st_mtime_ns, stat.st_size)
+    return files
+
+
+def run_stages(fixtures: Fixtures, trace: bool) -> dict[str, Measurement]:
+    """
+    Run every stage once in a fresh output directory. Peak memory is only
+    measured when `trace` is set, as tracing slows the stages down.
+    """
+    measurements = {}
+    # start from a cold name memo, as a fresh process would
+    names.clear_name_memo()
+    os.makedirs(OUTPUT_DIRECTORY)
+    for name, stage in create_stages(fixtures):
+        before = snapshot_output()
+        if trace:
+            tracemalloc.start()
+        start = time.perf_counter()
+        stage()
+        seconds = time.perf_counter() - start
+        peak_memory = 0
+        if trace:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        output_bytes = sum(
+            size
+            for path, (mtime, size) in snapshot_output().items()
+            if before.get(path) != (mtime, size)
+        )
+        measurements[name] = Measurement(seconds, peak_memory, output_bytes)
+    shutil.rmtree(OUTPUT_DIRECTORY)
+    return measurements
+
+
+def benchmark(fixtures: Fixtures, repeat: int) -> dict[str, Measurement]:
+    """
+    Measure every stage: the best wall time of `repeat` runs, and the peak
+    traced memory and output size of one more traced run.
+    """
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            runs = [run_stages(fixtures, trace=False) for _ in range(repeat)]
+            traced = run_stages(fixtures, trace=True)
+        finally:
+            os.chdir(cwd)
+    return {
+        name: Measurement(
+            min(run[name].seconds for run in runs),
+            measurement.peak_memory,
+            measurement.output_bytes,
+        )
+        for name, measurement in traced.items()
+    }
+
+
+def find_regressions(
+    results: dict[str, dict[str, Measurement]],
+    baseline: dict[str, dict[str, dict[str, float]]],
+    time_tolerance: float,
+    memory_tolerance: float,
+) -> list[str]:
+    """Describe every measurement that exceeds its baseline beyond the tolerance."""
+    regressions = []
+    for scale, stages in results.items():
+        for stage, measurement in stages.items():
+            expected = baseline.get(scale, {}).get(stage)
+            if expected is None:
+                continue
+            for metric, tolerance in zip(
+                METRICS, [time_tolerance, memory_tolerance, memory_tolerance]
+            ):
+                value = getattr(measurement, metric)
+                if value > expected[metric] * (1 + tolerance):
+                    regressions.append(
+                        f"{stage} at {scale}x: {metric} {value:.4g} "
+                        f"against a baseline of {expected[metric]:.4g}"
+                    )
+    return regressions
+
+
+if __name__ == "__main__":
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help=f"store the upstream documents in {FIXTURE_DIRECTORY} first",
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        type=int,
+        nargs="+",
+        default=SCALES,
+        help="sizes of the synthetic catalogues, as multiples of the fixtures",
+    )
+    parser.add_argument(
+        "-n", "--repeat", type=int, default=3, help="timed runs per scale"
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative increase in wall time over the baseline",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.1,
+        help="allowed relative increase in peak memory and output size",
+    )
+    parser.add_argument(
+        "--baseline", default=BASELINE_PATH, help="baseline to compare against"
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="store the results as the new baseline instead of comparing",
+    )
+    fetch.add_arguments(parser)
+    args = parser.parse_args()
+    fetch.configure(args)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    if args.record:
+        record_fixtures()
+    # the stages log every file they write
+    logging.getLogger().setLevel(logging.WARNING)
+    baseline_path = os.path.abspath(args.baseline)
+    fixtures = load_fixtures()
+    results = {}
+    for factor in args.scale:
+        results[str(factor)] = benchmark(scale_fixtures(fixtures, factor), args.repeat)
+        for stage, measurement in results[str(factor)].items():
+            print(
+                f"{stage:>20} {factor:>4}x {measurement.seconds:9.3f} s "
+                f"{measurement.peak_memory / 1024 / 1024:9.1f} MiB peak "
+                f"{measurement.output_bytes / 1024 / 1024:9.1f} MiB written"
+            )
+    if args.update_baseline:
+        os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+        atomic_write(
+            baseline_path,
+            json.dumps(
+                {
+                    scale: {
+                        stage: measurement._asdict()
+                        for stage, measurement in stages.items()
+                    }
+                    for scale, stages in results.items()
+                },
+                indent=4,
+            ).encode(),
+        )
+        sys.exit(0)
+    try:
+        with open(baseline_path, encoding="utf-8") as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        logging.error(f"No baseline at {baseline_path}, run with --update-baseline")
+        sys.exit(1)
+    regressions = find_regressions(
+        results, baseline, args.time_tolerance, args.memory_tolerance
+    )
+    for regression in regressions:
+        logging.error(f"Regression in {regression}")
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,386 @@
+"""
+Build every asset in one process, skipping stages whose inputs are unchanged
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import threading
+import fetch
+import instrumentation
+import gen_images
+import gen_item_metadata
+import gen_container_metadata
+import refresh_prices
+import dedup
+import bundle
+import names
+from typing import Any, Callable, NamedTuple, Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from constants import CACHE_DIRECTORY, CSGO_API_URL, DEFAULT_ASSET_DOMAIN
+from constants import OUTPUT_DIRECTORY
+from output import atomic_write
+from instrumentation import recorder
+from markets import MARKETS
+from image_pipeline import make_image_directories
+from aliases import AliasIndex
+
+BUILD_STATE_PATH = os.path.join(CACHE_DIRECTORY, "build_state.json")
+
+
+class Document:
+    """An upstream document, fetched once and parsed once for every stage."""
+
+    def __init__(self, body: bytes) -> None:
+        self.body = body
+        self.digest = hashlib.sha256(body).hexdigest()
+        self._lock = threading.Lock()
+        self._data: Any = None
+        self._parsed = False
+
+    def json(self) -> Any:
+        with self._lock:
+            if not self._parsed:
+                self._data = json.loads(self.body)
+                self._parsed = True
+            return self._data
+
+
+class Source(NamedTuple):
+    """An upstream document, fetched on every build to fingerprint it."""
+
+    name: str
+    url: str
+    headers: Optional[Callable[[], dict[str, str]]] = None
+    ttl: Optional[float] = None
+
+    def fetch(self) -> Document:
+        headers = None if self.headers is None else self.headers()
+        with recorder.span("fetch"), recorder.span(self.name):
+            return Document(
+                b"".join(fetch.upstream.stream_bytes(self.url, headers, self.ttl))
+            )
+
+
+class Stage(NamedTuple):
+    """
+    A build step. `run` receives the documents of the sources it depends on;
+    dependencies on other stages only order the build. The stage is skipped
+    when its fingerprint, derived from `config` and the fingerprints of its
+    dependencies, matches the one recorded by the last successful build.
+    """
+
+    name: str
+    dependencies: tuple[str, ...]
+    run: Callable[[dict[str, Document]], None]
+    config: tuple[Any, ...] = ()
+
+
+class Scheduler:
+    """
+    Run sources and stages on a thread pool as soon as their dependencies
+    have finished, so independent stages run concurrently.
+    """
+
+    def __init__(
+        self,
+        sources: list[Source],
+        stages: list[Stage],
+        state_path: str = BUILD_STATE_PATH,
+        force: frozenset[str] = frozenset(),
+    ) -> None:
+        self.sources = sources
+        self.stages = {stage.name: stage for stage in stages}
+        self.pending = dict(self.stages)
+        self.state_path = state_path
+        self.force = force
+        self.state = self._load_state()
+        self.documents: dict[str, Document] = {}
+        self.fingerprints: dict[str, str] = {}
+        self.failed: set[str] = set()
+        self.running: dict[Future[Any], str] = {}
+
+    def _load_state(self) -> dict[str, str]:
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                state: dict[str, str] = json.load(f)
+        except FileNotFoundError:
+            return {}
+        return state
+
+    def _save_state(self) -> None:
+        os.makedirs(os.path.dirname(self.state_path) or ".", exist_ok=True)
+        atomic_write(self.state_path, json.dumps(self.state, indent=4).encode())
+
+    def _fingerprint(self, stage: Stage) -> str:
+        inputs = [stage.name, list(stage.config)]
+        inputs.extend(
+            self.fingerprints[dependency] for dependency in stage.dependencies
+        )
+        return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+    def _schedule(self, executor: ThreadPoolExecutor) -> None:
+        """Start, skip or fail every pending stage whose dependencies are done."""
+        progress = True
+        while progress:
+            progress = False
+            for stage in list(self.pending.values()):
+                if any(dependency in self.failed for dependency in stage.dependencies):
+                    logging.error(f"Not running {stage.name}, a dependency failed")
+                    self.failed.add(stage.name)
+                elif all(
+                    dependency in self.fingerprints for dependency in stage.dependencies
+                ):
+                    fingerprint = self._fingerprint(stage)
+                    if (
+                        stage.name not in self.force
+                        and self.state.get(stage.name) == fingerprint
+                    ):
+                        logging.info(f"Skipping {stage.name}, inputs unchanged")
+                        recorder.count("stages", result="skipped")
+                        self.fingerprints[stage.name] = fingerprint
+                    else:
+                        logging.info(f"Starting {stage.name}")
+                        documents = {
+                            dependency: self.documents[dependency]
+                            for dependency in stage.dependencies
+                            if dependency in self.documents
+                        }
+                        self.running[
+                            executor.submit(self._run_stage, stage, documents)
+                        ] = stage.name
+                else:
+                    continue
+                del self.pending[stage.name]
+                progress = True
+
+    @staticmethod
+    def _run_stage(stage: Stage, documents: dict[str, Document]) -> None:
+        with recorder.span(stage.name):
+            stage.run(documents)
+
+    def _finish(self, future: Future[Any], name: str) -> None:
+        try:
+            result = future.result()
+        except Exception:
+            logging.exception(f"{name} failed")
+            recorder.count("stages", result="failed")
+            self.failed.add(name)
+            return
+        if isinstance(result, Document):
+            self.documents[name] = result
+            self.fingerprints[name] = result.digest
+            return
+        fingerprint = self._fingerprint(self.stages[name])
+        self.fingerprints[name] = fingerprint
+        # record progress as it happens so an interrupted build resumes
+        self.state[name] = fingerprint
+        self._save_state()
+        recorder.count("stages", result="finished")
+        logging.info(f"Finished {name}")
+
+    def run(self) -> bool:
+        """Run the build, returning whether every stage succeeded."""
+        with ThreadPoolExecutor(
+            max_workers=len(self.sources) + len(self.pending)
+        ) as executor:
+            for source in self.sources:
+                self.running[executor.submit(source.fetch)] = source.name
+            while self.running:
+                done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    self._finish(future, self.running.pop(future))
+                self._schedule(executor)
+        return not self.failed
+
+
+def create_build(args: argparse.Namespace) -> tuple[list[Source], list[Stage]]:
+    skinport = MARKETS["skinport"]
+    sources = [
+        Source("all", f"{CSGO_API_URL}/all.json"),
+        Source("skins", f"{CSGO_API_URL}/skins.json"),
+        Source("skins_not_grouped", f"{CSGO_API_URL}/skins_not_grouped.json"),
+        Source("crates", f"{CSGO_API_URL}/crates.json"),
+        Source("skinport", skinport.url, skinport.headers, skinport.ttl),
+    ]
+    # image URLs resolve through the alias index once the images are done
+    aliases = args.no_symlinks and not args.no_images
+    image_stages = ("dedup",) if aliases else ()
+    stages = [
+        Stage(
+            "item_metadata",
+            ("all", *image_stages),
+            lambda documents: gen_item_metadata.generate(
+                documents["all"].json().items(),
+                args.domain,
+                args.jobs,
+                AliasIndex.load() if aliases else None,
+            ),
+            (args.domain, aliases),
+        ),
+        Stage(
+            "container_metadata",
+            ("skins", "crates", *image_stages),
+            lambda documents: gen_container_metadata.generate(
+                documents["crates"].json(),
+                gen_container_metadata.get_skin_float_ranges(documents["skins"].json()),
+                args.domain,
+                args.jobs,
+                AliasIndex.load() if aliases else None,
+                args.cbor,
+            ),
+            (args.domain, args.cbor, aliases),
+        ),
+        Stage(
+            "names",
+            ("item_metadata", "container_metadata"),
+            lambda documents: names.write_name_index(),
+        ),
+        Stage(
+            "prices",
+            ("skinport", "item_metadata", "container_metadata"),
+            lambda documents: refresh_prices.refresh(
+                skinport.to_frame(documents["skinport"].json()),
+                args.price_store,
+                args.delta,
+                args.history,
+            ),
+            (args.price_store, args.delta, args.history),
+        ),
+    ]
+    if not args.no_images:
+        stages.append(
+            Stage(
+                "images",
+                ("skins", "skins_not_grouped"),
+                lambda documents: gen_images.generate(
+                    documents["skins"].json(),
+                    documents["skins_not_grouped"].json(),
+                    workers=args.workers,
+                    rate=args.rate,
+                    jobs=args.image_jobs,
+                    full=args.full,
+                    symlinks=not args.no_symlinks,
+                ),
+                (args.no_symlinks,),
+            )
+        )
+        stages.append(
+            Stage(
+                "dedup",
+                ("images",),
+                lambda documents: dedup.deduplicate(link=not args.no_symlinks).log(),
+                (args.no_symlinks,),
+            )
+        )
+        if args.bundle:
+            stages.append(
+                Stage(
+                    "bundle",
+                    ("dedup", "container_metadata"),
+                    lambda documents: bundle.write_bundles(),
+                )
+            )
+    # only fetch the documents a stage reads
+    needed = {dependency for stage in stages for dependency in stage.dependencies}
+    return [source for source in sources if source.name in needed], stages
+
+
+if __name__ == "__main__":
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        prog="build",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-d", "--domain", default=DEFAULT_ASSET_DOMAIN, help="asset domain URL"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="processes to generate the metadata on",
+    )
+    parser.add_argument(
+        "--cbor",
+        action="store_true",
+        help="also write CBOR encodings of the loot tables",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="run every stage, even those whose inputs are unchanged",
+    )
+    images = parser.add_argument_group("images")
+    images.add_argument(
+        "--no-images", action="store_true", help="do not download images"
+    )
+    images.add_argument(
+        "-w", "--workers", type=int, default=8, help="concurrent download threads"
+    )
+    images.add_argument(
+        "-r", "--rate", type=float, default=4.0, help="maximum requests per second"
+    )
+    images.add_argument(
+        "--image-jobs",
+        type=int,
+        default=None,
+        help="image encoding processes (default: available cores)",
+    )
+    images.add_argument(
+        "--bundle",
+        action="store_true",
+        help="also write the sprite atlases and the image pack",
+    )
+    images.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore the download manifest and regenerate every image",
+    )
+    images.add_argument(
+        "--no-symlinks",
+        action="store_true",
+        help="write the image alias index instead of symlinks, and point the "
+        "image URLs at the files it names",
+    )
+    prices = parser.add_argument_group("prices")
+    mode = prices.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--delta",
+        action="store_true",
+        help="only rewrite files whose prices changed",
+    )
+    mode.add_argument(
+        "--price-store",
+        action="store_true",
+        help="write prices to the price store instead of the metadata files",
+    )
+    prices.add_argument(
+        "--history",
+        action="store_true",
+        help="append the prices to the price history and refresh its aggregates",
+    )
+    fetch.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    fetch.configure(args)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    instrumentation.configure(args)
+    # folder structure
+    os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
+    make_image_directories()
+    # run
+    sources, stages = create_build(args)
+    force = frozenset(stage.name for stage in stages) if args.force else frozenset()
+    if args.full:
+        force |= {"images"}
+    if not Scheduler(sources, stages, force=force).run():
+        sys.exit(1)
@@ -0,0 +1,230 @@
+"""
+Bundle the generated images into sprite atlases and a memory-mappable pack
+"""
+
+import os
+import sys
+import json
+import math
+import mmap
+import shutil
+import logging
+import argparse
+import instrumentation
+from typing import Any, Iterator, NamedTuple, Optional
+from PIL import Image
+from constants import OUTPUT_DIRECTORY
+from output import write_json
+from aliases import AliasIndex
+from instrumentation import recorder
+
+ATLAS_DIRECTORY = os.path.join("images", "atlases")
+ATLAS_INDEX_FILE = "atlases.json"
+PACK_FILE = "images.pack"
+PACK_INDEX_FILE = "images_pack.json"
+PACK_DIRECTORIES = [
+    os.path.join("images", "unformatted"),
+    os.path.join("images", "preview"),
+]
+CONTAINER_FILES = [
+    "skin_cases.json",
+    "souvenir_packages.json",
+    "sticker_capsules.json",
+]
+# edge length in pixels of one atlas cell
+SPRITE_SIZE = 128
+
+
+def local_image_path(image_url: str) -> str:
+    """Path, relative to `OUTPUT_DIRECTORY`, of a generated image URL."""
+    return image_url.split("/generated/", 1)[1]
+
+
+def load_container_images() -> dict[str, list[tuple[str, str]]]:
+    """(unformatted name, image path) of every item in every container."""
+    containers = {}
+    for file in CONTAINER_FILES:
+        try:
+            with open(os.path.join(OUTPUT_DIRECTORY, file), encoding="utf-8") as f:
+                metadata: dict[str, Any] = json.load(f)
+        except FileNotFoundError:
+            continue
+        for key, container in metadata.items():
+            entries = [
+                entry
+                for rarity in sorted(container["contains"], key=int)
+                for entry in container["contains"][rarity]
+            ] + container["contains_rare"]
+            containers[key] = [
+                (entry["unformatted_name"], local_image_path(entry["image_url"]))
+                for entry in entries
+            ]
+    return containers
+
+
+def write_atlas(
+    key: str, images: list[tuple[str, str]], sprite_size: int
+) -> Optional[dict[str, Any]]:
+    """
+    Pack `images` into a grid of `sprite_size` cells and write it as
+    `images/atlases/<key>.webp`. Returns the atlas' entry of the coordinate
+    map, with `[x, y, width, height]` of every sprite, or `None` if none of
+    the images exist.
+    """
+    sprites = []
+    for name, path in images:
+        full_path = os.path.join(OUTPUT_DIRECTORY, path)
+        if not os.path.exists(full_path):
+            logging.warning(f"Missing image for {name} in {key}: {path}")
+            continue
+        sprites.append((name, full_path))
+    if not sprites:
+        return None
+    columns = math.ceil(math.sqrt(len(sprites)))
+    rows = math.ceil(len(sprites) / columns)
+    atlas = Image.new("RGBA", (columns * sprite_size, rows * sprite_size))
+    coordinates = {}
+    for idx, (name, full_path) in enumerate(sprites):
+        with Image.open(full_path) as image:
+            image.thumbnail((sprite_size, sprite_size), Image.Resampling.LANCZOS)
+            x = idx % columns * sprite_size
+            y = idx // columns * sprite_size
+            atlas.paste(image.convert("RGBA"), (x, y))
+            coordinates[name] = [x, y, image.width, image.height]
+    path = os.path.join(ATLAS_DIRECTORY, f"{key}.webp")
+    atlas.save(os.path.join(OUTPUT_DIRECTORY, path), format="WEBP", lossless=True)
+    return {"image": path, "sprites": coordinates}
+
+
+def write_atlases(sprite_size: int = SPRITE_SIZE) -> None:
+    """Write one sprite atlas per container and the `atlases.json` coordinate map."""
+    os.makedirs(os.path.join(OUTPUT_DIRECTORY, ATLAS_DIRECTORY), exist_ok=True)
+    atlases = {}
+    with recorder.span("atlases"):
+        for key, images in load_container_images().items():
+            atlas = write_atlas(key, images, sprite_size)
+            if atlas is not None:
+                atlases[key] = atlas
+    write_json(ATLAS_INDEX_FILE, {"sprite_size": sprite_size, "atlases": atlases})
+    logging.info(f"Wrote {len(atlases)} sprite atlases")
+
+
+def pack_sources(directories: list[str]) -> Iterator[tuple[str, str]]:
+    """
+    (image path, file to read) of every image in `directories`, relative to
+    `OUTPUT_DIRECTORY`, including the names recorded in the alias index.
+    """
+    for directory in directories:
+        for root, _, filenames in sorted(
+            os.walk(os.path.join(OUTPUT_DIRECTORY, directory))
+        ):
+            for filename in sorted(filenames):
+                path = os.path.relpath(os.path.join(root, filename), OUTPUT_DIRECTORY)
+                yield path, path
+    if AliasIndex.exists():
+        for path, source in AliasIndex.load().paths():
+            if any(path.startswith(directory + os.sep) for directory in directories):
+                yield path, source
+
+
+def write_pack(directories: list[str] = PACK_DIRECTORIES) -> None:
+    """
+    Concatenate every image in `directories` (relative to `OUTPUT_DIRECTORY`)
+    into one uncompressed `images.pack`, and write `images_pack.json` mapping
+    each image path to its `[offset, length]` in the pack. Files behind
+    symlinks or aliases to the same target are stored once.
+    """
+    files: dict[str, list[int]] = {}
+    stored: dict[str, list[int]] = {}
+    pack_path = os.path.join(OUTPUT_DIRECTORY, PACK_FILE)
+    tmp_path = f"{pack_path}.tmp"
+    with recorder.span("pack"), open(tmp_path, "wb") as pack:
+        for path, source in pack_sources(directories):
+            target = os.path.realpath(os.path.join(OUTPUT_DIRECTORY, source))
+            if not os.path.isfile(target):
+                continue
+            if target not in stored:
+                offset = pack.tell()
+                with open(target, "rb") as f:
+                    shutil.copyfileobj(f, pack)
+                stored[target] = [offset, pack.tell() - offset]
+            files[path] = stored[target]
+        pack.flush()
+        os.fsync(pack.fileno())
+    os.replace(tmp_path, pack_path)
+    recorder.count("written_bytes", os.path.getsize(pack_path))
+    write_json(PACK_INDEX_FILE, {"pack": PACK_FILE, "files": files})
+    logging.info(
+        f"Packed {len(files)} images ({len(stored)} distinct) into {PACK_FILE}"
+    )
+
+
+def write_bundles(sprite_size: int = SPRITE_SIZE) -> None:
+    write_atlases(sprite_size)
+    write_pack()
+
+
+class PackEntry(NamedTuple):
+    offset: int
+    length: int
+
+
+class PackReader:
+    """Serve images out of `images.pack` as slices of one shared mapping."""
+
+    def __init__(self, directory: str = OUTPUT_DIRECTORY) -> None:
+        with open(os.path.join(directory, PACK_INDEX_FILE), encoding="utf-8") as f:
+            index = json.load(f)
+        self.entries = {
+            path: PackEntry(offset, length)
+            for path, (offset, length) in index["files"].items()
+        }
+        # an empty file cannot be mapped, and an empty pack has nothing to serve
+        self.map: Optional[mmap.mmap] = None
+        with open(os.path.join(directory, index["pack"]), "rb") as f:
+            if os.fstat(f.fileno()).st_size > 0:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, path: str) -> Optional[memoryview]:
+        entry = self.entries.get(path)
+        if entry is None:
+            return None
+        if self.map is None:
+            return memoryview(b"")
+        return memoryview(self.map)[entry.offset : entry.offset + entry.length]
+
+    def close(self) -> None:
+        if self.map is not None:
+            self.map.close()
+
+
+if __name__ == "__main__":
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        prog="bundle",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--sprite-size",
+        type=int,
+        default=SPRITE_SIZE,
+        help="edge length in pixels of one atlas cell",
+    )
+    parser.add_argument(
+        "--no-atlases", action="store_true", help="do not write sprite atlases"
+    )
+    parser.add_argument(
+        "--no-pack", action="store_true", help="do not write the image pack"
+    )
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    instrumentation.configure(args)
+    if not args.no_atlases:
+        write_atlases(args.sprite_size)
+    if not args.no_pack:
+        write_pack()
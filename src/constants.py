@@ -1,7 +1,24 @@
 import os
+from spacecases_common import Rarity
 
 OUTPUT_DIRECTORY = os.path.join("assets", "generated")
 LOG_DIRECTORY = "logs"
+CACHE_DIRECTORY = "cache"
+HISTORY_DIRECTORY = "history"
+CSGO_API_URL = "https://bymykel.github.io/CSGO-API/api/en"
+SKINPORT_ITEMS_URL = "https://api.skinport.com/v1/items"
+# relative odds of each rarity tier when opening a container, each tier is
+# five times rarer than the one below it
+RARITY_WEIGHTS = {rarity: 5.0**-rarity for rarity in Rarity}
+# knives and gloves are 0.26% against 0.64% for covert skins
+RARE_SPECIAL_WEIGHT = RARITY_WEIGHTS[Rarity.Ancient] * 0.26 / 0.64
+METADATA_FILES = [
+    "skin_metadata.json",
+    "sticker_metadata.json",
+    "skin_cases.json",
+    "sticker_capsules.json",
+    "souvenir_packages.json",
+]
 DEFAULT_ASSET_DOMAIN = "https://assets.spacecases.xyz"
 VANILLA_KNIVES = {
     "★ Bayonet",
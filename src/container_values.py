@@ -0,0 +1,196 @@
+"""
+Expected value and price distribution of opening each container
+"""
+
+import time
+import numpy as np
+import numpy.typing as npt
+from typing import Any, Mapping, NamedTuple
+from spacecases_common import (
+    Condition,
+    Container,
+    PhaseGroup,
+)
+from names import remove_skin_name_formatting
+from output import write_json
+from sampling import NO_PHASE_GROUP, SamplingIndex
+from util import get_all_conditions_for_float_range, get_condition_float_range
+
+CONTAINER_VALUES_FILE = "container_values.json"
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+class Outcomes(NamedTuple):
+    """
+    Priced outcomes of every item in a `SamplingIndex`, as a CSR layout:
+    item `i` owns outcomes `start[i]:start[i + 1]`, each with the fraction
+    of the item's drops that land on it and its price in cents.
+    """
+
+    start: npt.NDArray[np.int64]
+    fraction: npt.NDArray[np.float64]
+    price: npt.NDArray[np.float64]
+    priced: npt.NDArray[np.bool_]
+
+
+def expand_item(
+    unformatted_name: str,
+    min_float: float,
+    max_float: float,
+    phase_group: int,
+) -> list[tuple[float, str]]:
+    """
+    Split an item into the metadata entries it can drop as, with the fraction
+    of drops that land on each: one per condition its float range overlaps,
+    and one per phase for items in a phase group.
+    """
+    if np.isnan(min_float):
+        return [(1.0, unformatted_name)]
+    if min_float < max_float:
+        conditions = get_all_conditions_for_float_range(min_float, max_float)
+    else:
+        # a fixed float always drops in the same condition
+        conditions = [
+            next(
+                condition
+                for condition in reversed(Condition)
+                if get_condition_float_range(condition)[0] <= min_float
+            )
+        ]
+    phases = (
+        [""]
+        if phase_group == NO_PHASE_GROUP
+        else [
+            remove_skin_name_formatting(phase)
+            for phase in PhaseGroup(phase_group).get_phases()
+        ]
+    )
+    outcomes = []
+    for condition in conditions:
+        if len(conditions) == 1:
+            fraction = 1.0
+        else:
+            low, high = get_condition_float_range(condition)
+            overlap = min(high, max_float) - max(low, min_float)
+            fraction = max(overlap, 0.0) / (max_float - min_float)
+        suffix = remove_skin_name_formatting(str(condition))
+        for phase in phases:
+            outcomes.append(
+                (fraction / len(phases), f"{unformatted_name}{phase}{suffix}")
+            )
+    return outcomes
+
+
+def build_outcomes(index: SamplingIndex, prices: Mapping[str, int]) -> Outcomes:
+    # every item has the same float range and phase group in every container
+    _, first_entry = np.unique(index.entry_name_id, return_index=True)
+    start = [0]
+    fraction: list[float] = []
+    price: list[int] = []
+    priced: list[bool] = []
+    for name_id, entry in enumerate(first_entry):
+        for item_fraction, key in expand_item(
+            str(index.names[name_id]),
+            float(index.min_float[entry]),
+            float(index.max_float[entry]),
+            int(index.phase_group[entry]),
+        ):
+            fraction.append(item_fraction)
+            price.append(prices.get(key, 0))
+            priced.append(prices.get(key, 0) > 0)
+        start.append(len(fraction))
+    return Outcomes(
+        start=np.array(start, dtype=np.int64),
+        fraction=np.array(fraction, dtype=np.float64),
+        price=np.array(price, dtype=np.float64),
+        priced=np.array(priced, dtype=np.bool_),
+    )
+
+
+def compute_container_values(
+    containers: Mapping[str, Container], prices: Mapping[str, int]
+) -> dict[str, dict[str, Any]]:
+    """
+    Expected value, variance and price percentiles in cents of one opening
+    of every container, with `priced` the probability that the drop has a
+    price. Computed for all containers at once over flat outcome arrays.
+    """
+    index = SamplingIndex.build(containers)
+    outcomes = build_outcomes(index, prices)
+    tier_count = np.diff(index.container_tier_start)
+    entry_count = np.diff(index.tier_entry_start)
+    # probability of each tier, from the cumulative thresholds
+    previous = np.concatenate([[0.0], index.tier_threshold[:-1]])
+    previous[index.container_tier_start[:-1][tier_count > 0]] = 0.0
+    tier_probability = index.tier_threshold - previous
+    # probability of each entry, items within a tier being equally likely
+    entry_tier = np.repeat(np.arange(len(entry_count)), entry_count)
+    entry_probability = tier_probability[entry_tier] / entry_count[entry_tier]
+    entry_container = np.repeat(np.arange(len(tier_count)), tier_count)[entry_tier]
+    # expand every entry into its item's outcomes
+    name_start = outcomes.start[index.entry_name_id]
+    outcome_count = outcomes.start[index.entry_name_id + 1] - name_start
+    outcome_entry = np.repeat(np.arange(len(outcome_count)), outcome_count)
+    offset = np.arange(len(outcome_entry)) - np.repeat(
+        np.cumsum(outcome_count) - outcome_count, outcome_count
+    )
+    outcome = name_start[outcome_entry] + offset
+    container = entry_container[outcome_entry]
+    probability = entry_probability[outcome_entry] * outcomes.fraction[outcome]
+    price = outcomes.price[outcome]
+    # moments
+    size = len(index.containers)
+    expected = np.bincount(container, probability * price, minlength=size)
+    second_moment = np.bincount(container, probability * price**2, minlength=size)
+    variance = np.maximum(second_moment - expected**2, 0.0)
+    priced = np.bincount(
+        container, probability * outcomes.priced[outcome], minlength=size
+    )
+    # percentiles, from the cumulative probability of outcomes sorted by price
+    order = np.lexsort((price, container))
+    container, probability, price = container[order], probability[order], price[order]
+    cumulative = np.cumsum(probability)
+    total = np.bincount(container, probability, minlength=size)
+    container_start = np.cumsum(total) - total
+    # offsetting by the container id keeps the keys sorted across containers
+    key = container + (cumulative - container_start[container]) / np.maximum(
+        total[container], np.finfo(np.float64).tiny
+    )
+    container_end = np.searchsorted(container, np.arange(size), side="right") - 1
+    percentiles = np.stack(
+        [
+            price[
+                np.minimum(
+                    np.searchsorted(key, np.arange(size) + q / 100),
+                    container_end,
+                )
+            ]
+            for q in PERCENTILES
+        ],
+        axis=1,
+    )
+    has_items = np.bincount(container, minlength=size) > 0
+    return {
+        str(name): {
+            "expected_value": int(expected[idx]),
+            "variance": int(variance[idx]),
+            "percentiles": [int(p) for p in percentiles[idx]],
+            "priced": round(float(priced[idx]), 4),
+        }
+        for idx, name in enumerate(index.containers)
+        if has_items[idx]
+    }
+
+
+def write_container_values(
+    containers: Mapping[str, Container], prices: Mapping[str, int]
+) -> None:
+    """Write `container_values.json` into `OUTPUT_DIRECTORY`."""
+    write_json(
+        CONTAINER_VALUES_FILE,
+        {
+            "updated_at": int(time.time()),
+            "percentiles": PERCENTILES,
+            "containers": compute_container_values(containers, prices),
+        },
+    )
@@ -0,0 +1,230 @@
+"""
+Deduplicate generated raw images into shared content-addressed blobs
+"""
+
+import os
+import sys
+import hashlib
+import logging
+import argparse
+import instrumentation
+from typing import NamedTuple
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from constants import OUTPUT_DIRECTORY
+from aliases import AliasIndex
+from instrumentation import recorder
+
+RAW_DIRECTORY = os.path.join(OUTPUT_DIRECTORY, "images", "raw")
+BLOB_DIRECTORY = os.path.join(OUTPUT_DIRECTORY, "images", "blobs")
+
+
+class DedupReport(NamedTuple):
+    files: int
+    duplicates: int
+    bytes_saved: int
+    blobs_removed: int
+
+    def log(self) -> None:
+        logging.info(
+            f"{self.duplicates} of {self.files} raw images were duplicates, "
+            f"saving {self.bytes_saved / 1024 / 1024:.1f} MiB; "
+            f"removed {self.blobs_removed} unreferenced blobs"
+        )
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def dhash(image: Image.Image) -> int:
+    """
+    Difference hash: one bit per horizontally adjacent pixel pair of a 9x8
+    grayscale thumbnail, set where brightness increases.
+    """
+    pixels = list(image.convert("L").resize((9, 8), Image.Resampling.LANCZOS).getdata())
+    bits = 0
+    for row in range(8):
+        for column in range(8):
+            left = pixels[row * 9 + column]
+            right = pixels[row * 9 + column + 1]
+            bits = bits << 1 | (right > left)
+    return bits
+
+
+def raw_files() -> list[str]:
+    """Every regular file under the raw image directory, skipping symlinks."""
+    paths = []
+    for root, _, filenames in os.walk(RAW_DIRECTORY):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if not os.path.islink(path):
+                paths.append(path)
+    return sorted(paths)
+
+
+def blob_path(digest: str, extension: str) -> str:
+    return os.path.join(BLOB_DIRECTORY, f"{digest}{extension}")
+
+
+def find_visual_duplicates(paths: list[str]) -> list[list[str]]:
+    """
+    Group images that decode to the same pixels. The dHash buckets candidates
+    so only images that already look alike are compared pixel for pixel,
+    which keeps images that differ by a thin StatTrak/Souvenir border apart.
+    """
+    buckets: dict[tuple[str, int, int, int], list[str]] = defaultdict(list)
+    for path in paths:
+        with Image.open(path) as image:
+            buckets[
+                (os.path.splitext(path)[1], image.width, image.height, dhash(image))
+            ].append(path)
+    groups: list[list[str]] = []
+    for bucket in buckets.values():
+        if len(bucket) < 2:
+            continue
+        by_pixels: dict[str, list[str]] = defaultdict(list)
+        for path in bucket:
+            with Image.open(path) as image:
+                by_pixels[
+                    hashlib.sha256(image.mode.encode() + image.tobytes()).hexdigest()
+                ].append(path)
+        groups.extend(group for group in by_pixels.values() if len(group) > 1)
+    return groups
+
+
+def link_to_blob(path: str, blob: str) -> None:
+    """Atomically replace `path` with a relative symlink to `blob`."""
+    tmp_path = f"{path}.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(os.path.relpath(blob, os.path.dirname(path)), tmp_path)
+    os.replace(tmp_path, path)
+
+
+def remove_unreferenced_blobs(index: AliasIndex) -> int:
+    """
+    Delete blobs that no raw image links to and `index` does not map a raw
+    image to, returning how many.
+    """
+    if not os.path.isdir(BLOB_DIRECTORY):
+        return 0
+    referenced = {
+        os.path.realpath(os.path.join(OUTPUT_DIRECTORY, blob))
+        for blob in index.blobs.values()
+    }
+    for root, _, filenames in os.walk(RAW_DIRECTORY):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if os.path.islink(path):
+                referenced.add(os.path.realpath(path))
+    removed = 0
+    for filename in os.listdir(BLOB_DIRECTORY):
+        path = os.path.join(BLOB_DIRECTORY, filename)
+        if os.path.realpath(path) not in referenced:
+            os.remove(path)
+            removed += 1
+    return removed
+
+
+def deduplicate(
+    dry_run: bool = False, workers: int = 8, link: bool = True
+) -> DedupReport:
+    """
+    Replace every set of byte-identical or pixel-identical raw images with
+    symlinks to one blob in `images/blobs`, named by the sha256 of its
+    content. The links in `images/unformatted` and `images/preview` keep
+    pointing at the raw paths, which now resolve to the blob. Without `link`,
+    the duplicates are deleted and the alias index maps them to the blob.
+    """
+    index = AliasIndex.load()
+    paths = raw_files()
+    if not dry_run:
+        # raw images written again since the last run replace their blobs
+        for path in paths:
+            index.blobs.pop(os.path.relpath(path, OUTPUT_DIRECTORY), None)
+    with recorder.span("hash"), ThreadPoolExecutor(workers) as executor:
+        digests = dict(zip(paths, executor.map(file_digest, paths)))
+    # byte-identical files, and files identical to an existing blob
+    by_content: dict[tuple[str, str], list[str]] = defaultdict(list)
+    for path, digest in digests.items():
+        by_content[(digest, os.path.splitext(path)[1])].append(path)
+    groups = []
+    unique = []
+    for (digest, extension), group in by_content.items():
+        if len(group) > 1 or os.path.exists(blob_path(digest, extension)):
+            groups.append(group)
+        else:
+            unique.extend(group)
+    # visually identical files with different encodings
+    with recorder.span("compare"):
+        groups.extend(find_visual_duplicates(unique))
+    duplicates = 0
+    bytes_saved = 0
+    if not dry_run:
+        os.makedirs(BLOB_DIRECTORY, exist_ok=True)
+    with recorder.span("link"):
+        for group in groups:
+            # the smallest encoding becomes the blob
+            group.sort(key=lambda path: (os.path.getsize(path), path))
+            keep = group[0]
+            blob = blob_path(digests[keep], os.path.splitext(keep)[1])
+            blob_exists = os.path.exists(blob)
+            for path in group:
+                if path == keep and not blob_exists:
+                    continue
+                duplicates += 1
+                bytes_saved += os.path.getsize(path)
+            if dry_run:
+                continue
+            if not blob_exists:
+                os.replace(keep, blob)
+            for path in group:
+                if link:
+                    link_to_blob(path, blob)
+                    continue
+                if os.path.exists(path):
+                    os.remove(path)
+                index.blobs[os.path.relpath(path, OUTPUT_DIRECTORY)] = os.path.relpath(
+                    blob, OUTPUT_DIRECTORY
+                )
+    blobs_removed = 0
+    if not dry_run:
+        with recorder.span("cleanup"):
+            blobs_removed = remove_unreferenced_blobs(index)
+        if not link:
+            index.save()
+    return DedupReport(len(paths), duplicates, bytes_saved, blobs_removed)
+
+
+if __name__ == "__main__":
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        prog="dedup",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        help="only report how much space deduplication would save",
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=8, help="concurrent hashing threads"
+    )
+    parser.add_argument(
+        "--no-symlinks",
+        action="store_true",
+        help="delete duplicates and map them to their blob in the alias index",
+    )
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    instrumentation.configure(args)
+    deduplicate(args.dry_run, args.workers, not args.no_symlinks).log()
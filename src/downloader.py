@@ -0,0 +1,216 @@
+"""
+Bounded-concurrency HTTP downloader with a global rate limit
+"""
+
+import time
+import random
+import hashlib
+import logging
+import threading
+import requests
+from typing import Callable, Optional
+from functools import partial
+from urllib.parse import urlsplit
+from concurrent.futures import Future, ThreadPoolExecutor
+from manifest import ImageManifest
+from instrumentation import recorder
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_EXCEPTIONS = (requests.ConnectionError, requests.Timeout)
+
+# called with the body of a download and a function recording the download in
+# the manifest, to be called once the files generated from it are written
+OnComplete = Callable[[bytes, Callable[[], None]], None]
+
+
+def do_nothing() -> None:
+    pass
+
+
+class TokenBucket:
+    """Thread-safe token bucket allowing `rate` acquisitions per second."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate = rate
+        self.capacity = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Downloader:
+    """
+    Download URLs on a thread pool.
+
+    Every request first takes a token from a global token bucket and a slot
+    from a per-host semaphore. Connection errors, timeouts and responses with a
+    retryable status code are retried with exponential backoff and full
+    jitter, honouring `Retry-After` up to `max_retry_after` seconds.
+
+    If a manifest is given, requests for URLs whose outputs already exist are
+    made conditional and the completion callback is skipped when the image is
+    unchanged. A changed image is only recorded in the manifest when the
+    callback reports its files as written, so a failed write is retried by
+    the next run.
+    """
+
+    def __init__(
+        self,
+        user_agents: list[str],
+        workers: int = 8,
+        rate: float = 4.0,
+        burst: int = 4,
+        per_host: int = 4,
+        max_retries: int = 5,
+        backoff: float = 1.0,
+        timeout: float = 30.0,
+        max_retry_after: float = 60.0,
+        manifest: Optional[ImageManifest] = None,
+    ) -> None:
+        self.user_agents = user_agents
+        self.manifest = manifest
+        self.bucket = TokenBucket(rate, burst)
+        self.per_host = per_host
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_retry_after = max_retry_after
+        self.host_semaphores: dict[str, threading.BoundedSemaphore] = {}
+        self.host_lock = threading.Lock()
+        self.local = threading.local()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures: list[Future[None]] = []
+
+    def _session(self) -> requests.Session:
+        session: Optional[requests.Session] = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            self.local.session = session
+        return session
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self.host_lock:
+            if host not in self.host_semaphores:
+                self.host_semaphores[host] = threading.BoundedSemaphore(self.per_host)
+            return self.host_semaphores[host]
+
+    def _retry_delay(
+        self, attempt: int, response: Optional[requests.Response] = None
+    ) -> float:
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after is not None and retry_after.isdigit():
+                return min(float(retry_after), self.max_retry_after)
+        return random.uniform(0, self.backoff * 2**attempt)
+
+    def get(
+        self, url: str, extra_headers: Optional[dict[str, str]] = None
+    ) -> requests.Response:
+        """
+        Make a rate limited GET request, retrying on connection errors,
+        timeouts and 429/5xx.
+        """
+        semaphore = self._host_semaphore(url)
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            headers = {"User-Agent": random.choice(self.user_agents)}
+            if extra_headers is not None:
+                headers.update(extra_headers)
+            try:
+                with semaphore:
+                    r = self._session().get(url, headers=headers, timeout=self.timeout)
+            except RETRY_EXCEPTIONS as e:
+                recorder.count("image_requests", status="error")
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                logging.warning(f"{e} from {url}, retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            recorder.count("image_requests", status=str(r.status_code))
+            recorder.count("image_downloaded_bytes", len(r.content))
+            if r.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                delay = self._retry_delay(attempt, r)
+                logging.warning(
+                    f"Got {r.status_code} from {url}, retrying in {delay:.2f}s"
+                )
+                time.sleep(delay)
+                continue
+            r.raise_for_status()
+            logging.info(f"Successfully made request to: {url}")
+            return r
+        raise AssertionError("unreachable")
+
+    def _download(self, url: str, files: list[str], on_complete: OnComplete) -> None:
+        with recorder.span("download"):
+            self._fetch(url, files, on_complete)
+
+    def _fetch(self, url: str, files: list[str], on_complete: OnComplete) -> None:
+        if self.manifest is None:
+            on_complete(self.get(url).content, do_nothing)
+            return
+        r = self.get(url, self.manifest.conditional_headers(url, files))
+        if r.status_code == 304:
+            logging.info(f"Not modified, skipping: {url}")
+            recorder.count("images_skipped", reason="not_modified")
+            return
+        sha256 = hashlib.sha256(r.content).hexdigest()
+        entry = self.manifest.get(url)
+        commit = partial(
+            self.manifest.record,
+            url,
+            r.headers.get("ETag"),
+            r.headers.get("Last-Modified"),
+            sha256,
+            files,
+        )
+        if (
+            entry is not None
+            and entry.sha256 == sha256
+            and self.manifest.is_complete(url, files)
+        ):
+            logging.info(f"Content unchanged, skipping: {url}")
+            recorder.count("images_skipped", reason="unchanged")
+            commit()
+        else:
+            on_complete(r.content, commit)
+
+    def submit(self, url: str, files: list[str], on_complete: OnComplete) -> None:
+        """
+        Queue `url` for download and call `on_complete` with its body.
+        `files` are the paths, relative to `OUTPUT_DIRECTORY`, that `on_complete`
+        writes, before calling the function it is passed.
+        """
+        self.futures.append(
+            self.executor.submit(self._download, url, files, on_complete)
+        )
+
+    def wait(self) -> None:
+        """Block until every queued download has finished, raising if any failed."""
+        futures, self.futures = self.futures, []
+        errors = 0
+        for future in futures:
+            exception = future.exception()
+            if exception is not None:
+                errors += 1
+                logging.error(f"Download failed: {exception}")
+        if errors:
+            raise RuntimeError(f"{errors}/{len(futures)} downloads failed")
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
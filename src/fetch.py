@@ -0,0 +1,181 @@
+"""
+Shared upstream fetching with connection pooling and an on-disk cache
+"""
+
+import os
+import json
+import time
+import codecs
+import hashlib
+import logging
+import argparse
+import requests
+from typing import Any, Iterator, Optional
+from requests.adapters import HTTPAdapter
+from constants import CACHE_DIRECTORY
+from output import atomic_write
+from instrumentation import recorder
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_TTL = 60 * 60
+
+
+class UpstreamCache:
+    """
+    Fetch upstream documents through one pooled `requests.Session`, caching
+    every body on disk keyed by URL.
+
+    A cached body younger than `ttl` seconds is replayed without a request.
+    Older ones are revalidated with `If-None-Match`/`If-Modified-Since`. In
+    offline mode only cached bodies are used.
+    """
+
+    def __init__(
+        self,
+        directory: str = CACHE_DIRECTORY,
+        ttl: float = DEFAULT_TTL,
+        offline: bool = False,
+    ) -> None:
+        self.directory = directory
+        self.ttl = ttl
+        self.offline = offline
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _paths(self, url: str) -> tuple[str, str]:
+        key = hashlib.sha256(url.encode()).hexdigest()
+        base = os.path.join(self.directory, key)
+        return f"{base}.body", f"{base}.json"
+
+    def _read_meta(self, url: str) -> Optional[dict[str, Any]]:
+        body_path, meta_path = self._paths(url)
+        if not os.path.exists(body_path):
+            return None
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                meta: dict[str, Any] = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return meta
+
+    def _write_meta(
+        self,
+        url: str,
+        response: requests.Response,
+        previous: Optional[dict[str, Any]] = None,
+    ) -> None:
+        _, meta_path = self._paths(url)
+        previous = previous or {}
+        meta = {
+            "url": url,
+            "etag": response.headers.get("ETag", previous.get("etag")),
+            "last_modified": response.headers.get(
+                "Last-Modified", previous.get("last_modified")
+            ),
+            "fetched_at": time.time(),
+        }
+        atomic_write(meta_path, json.dumps(meta, indent=4).encode())
+
+    def _replay(self, url: str) -> Iterator[bytes]:
+        body_path, _ = self._paths(url)
+        with open(body_path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+    def stream_bytes(
+        self,
+        url: str,
+        headers: Optional[dict[str, str]] = None,
+        ttl: Optional[float] = None,
+    ) -> Iterator[bytes]:
+        """Stream the body of `url`, from the cache where possible."""
+        if ttl is None:
+            ttl = self.ttl
+        meta = self._read_meta(url)
+        if self.offline:
+            if meta is None:
+                raise FileNotFoundError(f"{url} is not cached, cannot fetch offline")
+            logging.info(f"Replaying cached {url}")
+            recorder.count("upstream_requests", result="offline")
+            yield from self._replay(url)
+            return
+        if meta is not None and time.time() - meta["fetched_at"] < ttl:
+            logging.info(f"Using cached {url}")
+            recorder.count("upstream_requests", result="cached")
+            yield from self._replay(url)
+            return
+        request_headers = dict(headers or {})
+        if meta is not None:
+            if meta["etag"] is not None:
+                request_headers["If-None-Match"] = meta["etag"]
+            if meta["last_modified"] is not None:
+                request_headers["If-Modified-Since"] = meta["last_modified"]
+        with self.session.get(url, headers=request_headers, stream=True) as r:
+            r.raise_for_status()
+            if r.status_code == 304:
+                logging.info(f"Not modified, using cached {url}")
+                recorder.count("upstream_requests", result="not_modified")
+                self._write_meta(url, r, meta)
+                yield from self._replay(url)
+                return
+            logging.info(f"Fetching {url}")
+            recorder.count("upstream_requests", result="fetched")
+            os.makedirs(self.directory, exist_ok=True)
+            body_path, _ = self._paths(url)
+            tmp_path = f"{body_path}.tmp"
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    recorder.count("upstream_downloaded_bytes", len(chunk))
+                    yield chunk
+            # a body without validators is fetched again, so drop the old
+            # ones before the body changes, in case the new ones never land
+            _, meta_path = self._paths(url)
+            if os.path.exists(meta_path):
+                os.remove(meta_path)
+            os.replace(tmp_path, body_path)
+            self._write_meta(url, r)
+
+    def stream(
+        self,
+        url: str,
+        headers: Optional[dict[str, str]] = None,
+        ttl: Optional[float] = None,
+    ) -> Iterator[str]:
+        """Stream the body of `url` as UTF-8 text."""
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        for chunk in self.stream_bytes(url, headers, ttl):
+            yield decoder.decode(chunk)
+        yield decoder.decode(b"", final=True)
+
+    def get_json(
+        self,
+        url: str,
+        headers: Optional[dict[str, str]] = None,
+        ttl: Optional[float] = None,
+    ) -> Any:
+        return json.loads(b"".join(self.stream_bytes(url, headers, ttl)))
+
+
+upstream = UpstreamCache()
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="only use cached upstream documents",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=DEFAULT_TTL,
+        help="seconds a cached upstream document is used without revalidation",
+    )
+
+
+def configure(args: argparse.Namespace) -> None:
+    upstream.offline = args.offline
+    upstream.ttl = args.cache_ttl
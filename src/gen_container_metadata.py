@@ -4,13 +4,15 @@ Generate metadata for CS2 skin cases, soveunir packages and sticker capsules
 
 import os
 import sys
-import json
+import logging
 import argparse
-import requests
-from typing import NamedTuple, Optional, Any
+from typing import NamedTuple, Optional, Any, Iterable, Mapping
 from collections import defaultdict
-from constants import OUTPUT_DIRECTORY, DEFAULT_ASSET_DOMAIN
+import fetch
+import instrumentation
+from constants import OUTPUT_DIRECTORY, DEFAULT_ASSET_DOMAIN, CSGO_API_URL
 from spacecases_common import (
+    Container,
     SkinCase,
     Rarity,
     SkinContainerEntry,
@@ -18,9 +20,15 @@ from spacecases_common import (
     SouvenirPackage,
     StickerCapsule,
     PhaseGroup,
-    remove_skin_name_formatting,
 )
+from names import remove_skin_name_formatting, load_name_index, write_name_index
+from output import write_json
+from instrumentation import recorder
+from sampling import SamplingIndex
+from sharding import map_shards
+from streaming import iter_json_array, stream_document
 from util import create_image_url, get_rarity_from_string
+from aliases import AliasIndex
 
 
 class Result(NamedTuple):
@@ -29,6 +37,21 @@ class Result(NamedTuple):
     sticker_capsules: dict[str, StickerCapsule]
 
 
+class Context(NamedTuple):
+    """
+    What processing a container needs besides its upstream record. With
+    `aliases`, image URLs point at the files the alias index resolves names to.
+    """
+
+    asset_domain: str
+    float_ranges: dict[str, tuple[float, float]]
+    aliases: Optional[AliasIndex] = None
+
+
+# the context of the shards processed by this process, set by `init_worker`
+worker_context: Optional[Context] = None
+
+
 def get_phase_group_from_unformatted_name(
     unformatted_name: str,
 ) -> Optional[PhaseGroup]:
@@ -40,13 +63,18 @@ def get_phase_group_from_unformatted_name(
         return None
 
 
-def create_skin_container_entry_from_datum(datum: Any) -> SkinContainerEntry:
+def create_skin_container_entry_from_datum(
+    datum: Any, context: Context
+) -> SkinContainerEntry:
     item_formatted_name = datum["name"]
     item_unformatted_name = remove_skin_name_formatting(item_formatted_name)
-    min_float, max_float = float_ranges[item_unformatted_name]
+    min_float, max_float = context.float_ranges[item_unformatted_name]
     phase_group = get_phase_group_from_unformatted_name(item_unformatted_name)
-    image_url = os.path.join(
-        args.domain, "generated", "images", "preview", f"{item_unformatted_name}.png"
+    image_url = create_image_url(
+        item_unformatted_name,
+        context.asset_domain,
+        directory="preview",
+        aliases=context.aliases,
     )
     return SkinContainerEntry(
         unformatted_name=item_unformatted_name,
@@ -57,7 +85,9 @@ def create_skin_container_entry_from_datum(datum: Any) -> SkinContainerEntry:
     )
 
 
-def process_skin_case(skin_cases: dict[str, SkinCase], api_datum: Any) -> None:
+def process_skin_case(
+    skin_cases: dict[str, SkinCase], api_datum: Any, context: Context
+) -> None:
     formatted_name = api_datum["name"]
     unformatted_name = remove_skin_name_formatting(formatted_name)
     contains: dict[Rarity, list[SkinContainerEntry]] = defaultdict(
@@ -65,15 +95,15 @@ def process_skin_case(skin_cases: dict[str, SkinCase], api_datum: Any) -> None:
     )
     for item in api_datum["contains"]:
         rarity = get_rarity_from_string(item["rarity"]["id"])
-        contains[rarity].append(create_skin_container_entry_from_datum(item))
+        contains[rarity].append(create_skin_container_entry_from_datum(item, context))
     contains_rare = [
-        create_skin_container_entry_from_datum(item)
+        create_skin_container_entry_from_datum(item, context)
         for item in api_datum["contains_rare"]
     ]
     skin_cases[unformatted_name] = SkinCase(
         formatted_name=formatted_name,
         price=0,
-        image_url=create_image_url(unformatted_name, args.domain),
+        image_url=create_image_url(unformatted_name, context.asset_domain),
         requires_key=True,
         contains=contains,
         contains_rare=contains_rare,
@@ -81,7 +111,7 @@ def process_skin_case(skin_cases: dict[str, SkinCase], api_datum: Any) -> None:
 
 
 def process_souvenir_package(
-    souvenir_packages: dict[str, SouvenirPackage], api_datum: Any
+    souvenir_packages: dict[str, SouvenirPackage], api_datum: Any, context: Context
 ) -> None:
     formatted_name = api_datum["name"]
     unformatted_name = remove_skin_name_formatting(formatted_name)
@@ -90,11 +120,11 @@ def process_souvenir_package(
     )
     for item in api_datum["contains"]:
         rarity = get_rarity_from_string(item["rarity"]["id"])
-        contains[rarity].append(create_skin_container_entry_from_datum(item))
+        contains[rarity].append(create_skin_container_entry_from_datum(item, context))
     souvenir_packages[unformatted_name] = SouvenirPackage(
         formatted_name=formatted_name,
         price=0,
-        image_url=create_image_url(unformatted_name, args.domain),
+        image_url=create_image_url(unformatted_name, context.asset_domain),
         requires_key=False,
         contains=contains,
         contains_rare=[],
@@ -108,7 +138,7 @@ STICKER_CAPSULES_THAT_REQUIRE_KEYS = {
 
 
 def process_sticker_capsule(
-    sticker_capsules: dict[str, StickerCapsule], api_datum: Any
+    sticker_capsules: dict[str, StickerCapsule], api_datum: Any, context: Context
 ) -> None:
     formatted_name = api_datum["name"]
     unformatted_name = remove_skin_name_formatting(formatted_name)
@@ -123,7 +153,7 @@ def process_sticker_capsule(
             ItemContainerEntry(
                 unformatted_name=item_unformatted_name,
                 image_url=os.path.join(
-                    args.domain,
+                    context.asset_domain,
                     "generated",
                     "images",
                     "unformatted",
@@ -134,32 +164,41 @@ def process_sticker_capsule(
     sticker_capsules[unformatted_name] = StickerCapsule(
         formatted_name=formatted_name,
         price=0,
-        image_url=create_image_url(unformatted_name, args.domain),
+        image_url=create_image_url(unformatted_name, context.asset_domain),
         requires_key=unformatted_name in STICKER_CAPSULES_THAT_REQUIRE_KEYS,
         contains=contains,
         contains_rare=[],
     )
 
 
-def run(api_data: Any) -> Result:
+def run(api_data: Iterable[Any], context: Context) -> Result:
     skin_cases: dict[str, SkinCase] = {}
     souvenir_packages: dict[str, SouvenirPackage] = {}
     sticker_capsules: dict[str, StickerCapsule] = {}
     for datum in api_data:
         match datum["type"]:
             case "Case":
-                process_skin_case(skin_cases, datum)
+                process_skin_case(skin_cases, datum, context)
             case "Souvenir":
-                process_souvenir_package(souvenir_packages, datum)
+                process_souvenir_package(souvenir_packages, datum, context)
             case "Sticker Capsule":
-                process_sticker_capsule(sticker_capsules, datum)
+                process_sticker_capsule(sticker_capsules, datum, context)
     return Result(skin_cases, souvenir_packages, sticker_capsules)
 
 
-def get_skin_float_ranges() -> dict[str, tuple[float, float]]:
-    skin_data = requests.get(
-        "https://bymykel.github.io/CSGO-API/api/en/skins.json"
-    ).json()
+def init_worker(context: Context) -> None:
+    """Give this process the context of the shards it processes."""
+    global worker_context
+    worker_context = context
+
+
+def process_shard(shard: list[Any]) -> Result:
+    """Run a shard of the upstream records in the context of this process."""
+    assert worker_context is not None
+    return run(shard, worker_context)
+
+
+def get_skin_float_ranges(skin_data: Iterable[Any]) -> dict[str, tuple[float, float]]:
     float_ranges = {}
     for datum in skin_data:
         unformatted_name = remove_skin_name_formatting(datum["name"])
@@ -173,6 +212,56 @@ def get_skin_float_ranges() -> dict[str, tuple[float, float]]:
     return float_ranges
 
 
+def generate(
+    api_data: Iterable[Any],
+    skin_float_ranges: dict[str, tuple[float, float]],
+    asset_domain: str,
+    jobs: int = 1,
+    aliases: Optional[AliasIndex] = None,
+    cbor: bool = False,
+) -> None:
+    """
+    Generate and write the container metadata files and sampling index. With
+    `aliases`, image URLs point at the files the alias index resolves names
+    to. With `cbor`, CBOR encodings of the loot tables are written too.
+    """
+    context = Context(asset_domain, skin_float_ranges, aliases)
+    # a single job runs the shards in this process
+    init_worker(context)
+    # reuse the names normalised by the previous run
+    load_name_index()
+    # run script body, merging the shards in upstream order
+    result = Result({}, {}, {})
+    with recorder.span("process"):
+        for shard_result in map_shards(
+            process_shard,
+            api_data,
+            jobs,
+            initializer=init_worker,
+            initargs=(context,),
+        ):
+            result.skin_cases.update(shard_result.skin_cases)
+            result.souvenir_packages.update(shard_result.souvenir_packages)
+            result.sticker_capsules.update(shard_result.sticker_capsules)
+    skin_cases, souvenir_packages, sticker_capsules = result
+    recorder.count("records", len(skin_cases), kind="skin_case")
+    recorder.count("records", len(souvenir_packages), kind="souvenir_package")
+    recorder.count("records", len(sticker_capsules), kind="sticker_capsule")
+    # output to json
+    files: dict[str, Mapping[str, Container]] = {
+        "skin_cases.json": skin_cases,
+        "souvenir_packages.json": souvenir_packages,
+        "sticker_capsules.json": sticker_capsules,
+    }
+    for filename, containers in files.items():
+        dump = {key: value.model_dump() for key, value in containers.items()}
+        write_json(filename, dump, cbor=cbor)
+    with recorder.span("sampling_index"):
+        SamplingIndex.build(
+            {**skin_cases, **souvenir_packages, **sticker_capsules}
+        ).save()
+
+
 if __name__ == "__main__":
     # argument parsing
     parser = argparse.ArgumentParser(
@@ -184,38 +273,56 @@ if __name__ == "__main__":
     parser.add_argument(
         "-d", "--domain", default=DEFAULT_ASSET_DOMAIN, help="asset domain URL"
     )
+    parser.add_argument(
+        "--cbor",
+        action="store_true",
+        help="also write CBOR encodings of the loot tables",
+    )
+    parser.add_argument(
+        "--skins-source",
+        default=f"{CSGO_API_URL}/skins.json",
+        help="URL or local path of the CSGO-API skins.json document",
+    )
+    parser.add_argument(
+        "--crates-source",
+        default=f"{CSGO_API_URL}/crates.json",
+        help="URL or local path of the CSGO-API crates.json document",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="processes to generate the metadata on, in shards of upstream records",
+    )
+    parser.add_argument(
+        "--aliases",
+        action="store_true",
+        help="point image URLs at the files named by the image alias index",
+    )
+    fetch.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    fetch.configure(args)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    instrumentation.configure(args)
     # folder structure
     os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
     # obtain float ranges
-    float_ranges = get_skin_float_ranges()
-    # container api data
-    api_data = requests.get(
-        "https://bymykel.github.io/CSGO-API/api/en/crates.json"
-    ).json()
-    # run script body
-    skin_cases, souvenir_packages, sticker_capsules = run(api_data)
-    # output to json
-    with open(f"{OUTPUT_DIRECTORY}/skin_cases.json", "w+", encoding="utf-8") as f:
-        json.dump(
-            {key: value.model_dump() for key, value in skin_cases.items()},
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
-    with open(
-        f"{OUTPUT_DIRECTORY}/souvenir_packages.json", "w+", encoding="utf-8"
-    ) as f:
-        json.dump(
-            {key: value.model_dump() for key, value in souvenir_packages.items()},
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
-    with open(f"{OUTPUT_DIRECTORY}/sticker_capsules.json", "w+", encoding="utf-8") as f:
-        json.dump(
-            {key: value.model_dump() for key, value in sticker_capsules.items()},
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
+    float_ranges = get_skin_float_ranges(
+        iter_json_array(stream_document(args.skins_source))
+    )
+    # stream container api data
+    api_data = iter_json_array(stream_document(args.crates_source))
+    # run script body and output to json
+    generate(
+        api_data,
+        float_ranges,
+        args.domain,
+        args.jobs,
+        AliasIndex.load() if args.aliases else None,
+        args.cbor,
+    )
+    write_name_index()
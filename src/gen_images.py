@@ -3,60 +3,82 @@ Generate/download all images for CS2 skins, stickers and containers
 """
 
 import os
-import time
-import random
+import sys
 import logging
-import requests
-from typing import Any
+import argparse
+from typing import Any, Callable, Iterable, Optional
+from functools import partial
 from datetime import datetime
-from PIL import Image, ImageOps
-from io import BytesIO
-from spacecases_common import (
-    remove_skin_name_formatting,
-)
-from constants import OUTPUT_DIRECTORY, LOG_DIRECTORY, VANILLA_KNIVES
+import fetch
+import instrumentation
+from constants import OUTPUT_DIRECTORY, LOG_DIRECTORY, VANILLA_KNIVES, CSGO_API_URL
+from downloader import Downloader
+from instrumentation import recorder
+from image_pipeline import ImagePipeline, image_paths, make_image_directories
+from manifest import ImageManifest
+from names import remove_skin_name_formatting
+from streaming import iter_json_array, stream_document
 from util import get_all_conditions_for_float_range, Condition
+from aliases import AliasIndex
 
 
 CONDITION_IDX_TO_IMAGE_IDX = [0, 0, 1, 1, 2]
 
+# set when the names are recorded in the alias index instead of symlinked
+alias_index: Optional[AliasIndex] = None
+
 
 def create_symlink(source: str, destination: str) -> None:
     source = os.path.join(OUTPUT_DIRECTORY, source)
     destination = os.path.join(OUTPUT_DIRECTORY, destination)
     relative_source = os.path.relpath(source, os.path.dirname(destination))
+    # leave links from a previous run alone unless their target changed
+    if os.path.islink(destination):
+        if os.readlink(destination) == relative_source:
+            return
+        os.remove(destination)
+    elif os.path.exists(destination):
+        os.remove(destination)
     os.symlink(relative_source, destination)
 
 
 def create_skin_symlink(condition_image: str, symlink_name: str) -> None:
-    create_symlink(
-        os.path.join("images", "raw", f"{condition_image}.png"),
-        os.path.join("images", "unformatted", f"{symlink_name}.png"),
-    )
+    if alias_index is not None:
+        alias_index.add("unformatted", symlink_name, condition_image)
+        return
+    for source, destination in zip(
+        image_paths("raw", condition_image), image_paths("unformatted", symlink_name)
+    ):
+        create_symlink(source, destination)
 
 
 def create_preview_symlink(condition_image: str, symlink_name: str) -> None:
-    create_symlink(
-        os.path.join("images", "raw", f"{condition_image}.png"),
-        os.path.join("images", "preview", f"{symlink_name}.png"),
-    )
+    if alias_index is not None:
+        alias_index.add("preview", symlink_name, condition_image)
+        return
+    for source, destination in zip(
+        image_paths("raw", condition_image), image_paths("preview", symlink_name)
+    ):
+        create_symlink(source, destination)
 
 
 with open("user_agents.txt") as f:
     user_agents = [line.strip() for line in f.readlines()]
 
 
-def make_safe_request(url: str) -> requests.Response:
-    time.sleep(1)
-    user_agent = random.choice(user_agents)
-    headers = {"User-Agent": user_agent}
-    r = requests.get(url, headers=headers)
-    r.raise_for_status()
-    logging.info(f"Successfully made request to: {url}")
-    return r
+def submit_skin_images(
+    downloader: Downloader, pipeline: ImagePipeline, url: str, names: list[str]
+) -> None:
+    downloader.submit(
+        url,
+        [path for name in names for path in image_paths("raw", name)],
+        partial(pipeline.put, url, names),
+    )
 
 
 def process_normal_skin(
+    downloader: Downloader,
+    pipeline: ImagePipeline,
     name: str,
     images: dict[str, str],
     skin_datum: Any,
@@ -72,18 +94,15 @@ def process_normal_skin(
         for condition in conditions:
             if condition in available_conditions:
                 if name == "MP5-SD | Lab Rats":
-                    image_bytes = make_safe_request(
-                        images[f"Souvenir {name} ({condition})"]
-                    ).content
+                    image_url = images[f"Souvenir {name} ({condition})"]
                 else:
-                    image_bytes = make_safe_request(
-                        images[f"{name} ({condition})"]
-                    ).content
-                save_skin_image(f"{unformatted_name}{idx}", image_bytes)
+                    image_url = images[f"{name} ({condition})"]
+                image_names = [f"{unformatted_name}{idx}"]
                 if skin_datum["stattrak"]:
-                    save_skin_image(f"stattrak{unformatted_name}{idx}", image_bytes)
+                    image_names.append(f"stattrak{unformatted_name}{idx}")
                 if skin_datum["souvenir"]:
-                    save_skin_image(f"souvenir{unformatted_name}{idx}", image_bytes)
+                    image_names.append(f"souvenir{unformatted_name}{idx}")
+                submit_skin_images(downloader, pipeline, image_url, image_names)
                 break
 
     for count, condition in enumerate(available_conditions):
@@ -108,6 +127,8 @@ def process_normal_skin(
 
 
 def process_doppler_skin(
+    downloader: Downloader,
+    pipeline: ImagePipeline,
     name: str,
     images: dict[str, str],
     skin_datum: Any,
@@ -123,22 +144,17 @@ def process_doppler_skin(
     ]:
         for condition in conditions:
             if condition in available_conditions:
-                image_bytes = make_safe_request(
-                    images[f"{name} ({condition}) - {skin_datum['phase']}"]
-                ).content
-                save_skin_image(
-                    f"{unformatted_name}{unformatted_phase}{idx}", image_bytes
-                )
+                image_url = images[f"{name} ({condition}) - {skin_datum['phase']}"]
+                image_names = [f"{unformatted_name}{unformatted_phase}{idx}"]
                 if skin_datum["stattrak"]:
-                    save_skin_image(
-                        f"stattrak{unformatted_name}{unformatted_phase}{idx}",
-                        image_bytes,
+                    image_names.append(
+                        f"stattrak{unformatted_name}{unformatted_phase}{idx}"
                     )
                 if skin_datum["souvenir"]:
-                    save_skin_image(
-                        f"souvenir{unformatted_name}{unformatted_phase}{idx}",
-                        image_bytes,
+                    image_names.append(
+                        f"souvenir{unformatted_name}{unformatted_phase}{idx}"
                     )
+                submit_skin_images(downloader, pipeline, image_url, image_names)
                 break
 
     for count, condition in enumerate(available_conditions):
@@ -166,14 +182,17 @@ def process_doppler_skin(
             )
 
 
-def process_vanilla_knife(name: str, images: dict[str, str]) -> None:
+def process_vanilla_knife(
+    downloader: Downloader,
+    pipeline: ImagePipeline,
+    name: str,
+    images: dict[str, str],
+) -> None:
     logging.info(f"Processing vanilla knife: {name}")
     # save normal and stattrak version
     unformatted_name = remove_skin_name_formatting(name)
-    image_url = images[name]
-    image_bytes = make_safe_request(image_url).content
-    save_skin_image(unformatted_name, image_bytes)
-    save_skin_image(f"stattrak{unformatted_name}", image_bytes)
+    image_names = [unformatted_name, f"stattrak{unformatted_name}"]
+    submit_skin_images(downloader, pipeline, images[name], image_names)
     # create symlinks
     for count, condition in enumerate(Condition):
         unformatted_condition = remove_skin_name_formatting(str(condition))
@@ -185,28 +204,13 @@ def process_vanilla_knife(name: str, images: dict[str, str]) -> None:
         create_skin_symlink(f"stattrak{unformatted_name}", f"stattrak{full_name}")
 
 
-def save_skin_image(name: str, bytes: bytes) -> None:
-    if name.startswith("souvenir"):
-        image = Image.open(BytesIO(bytes))
-        bordered_image = ImageOps.expand(image, border=3, fill="#CF6A32")
-        bordered_image.save(f"{OUTPUT_DIRECTORY}/images/raw/{name}.png")
-    elif name.startswith("stattrak"):
-        image = Image.open(BytesIO(bytes))
-        bordered_image = ImageOps.expand(image, border=3, fill="#FFD700")
-        bordered_image.save(f"{OUTPUT_DIRECTORY}/images/raw/{name}.png")
-    else:
-        with open(f"{OUTPUT_DIRECTORY}/images/raw/{name}.png", "wb+") as f:
-            f.write(bytes)
-
-
-def run_for_skins() -> None:
+def run_for_skins(
+    downloader: Downloader,
+    pipeline: ImagePipeline,
+    skin_data: Iterable[Any],
+    ungrouped_skin_data: Iterable[Any],
+) -> None:
     logging.info("Starting skins")
-    grouped_skin_data = requests.get(
-        "https://bymykel.github.io/CSGO-API/api/en/skins.json"
-    ).json()
-    ungrouped_skin_data = requests.get(
-        "https://bymykel.github.io/CSGO-API/api/en/skins_not_grouped.json"
-    ).json()
     # images for each
     images = {}
     for datum in ungrouped_skin_data:
@@ -217,16 +221,14 @@ def run_for_skins() -> None:
         else:
             images[datum["name"]] = datum["image"]
 
-    for count, skin_datum in enumerate(grouped_skin_data, start=1):
+    for count, skin_datum in enumerate(skin_data, start=1):
         formatted_name = skin_datum["name"]
 
-        logging.info(
-            f"Starting item {count}/{len(grouped_skin_data)}: {formatted_name}"
-        )
+        logging.info(f"Starting item {count}: {formatted_name}")
 
         # Vanilla knives handled seperately
         if formatted_name in VANILLA_KNIVES:
-            process_vanilla_knife(formatted_name, images)
+            process_vanilla_knife(downloader, pipeline, formatted_name, images)
             continue
 
         available_conditions = set(
@@ -238,52 +240,175 @@ def run_for_skins() -> None:
         # Doppler skins handled seperately
         if "Doppler" in formatted_name:
             process_doppler_skin(
-                formatted_name, images, skin_datum, available_conditions
+                downloader,
+                pipeline,
+                formatted_name,
+                images,
+                skin_datum,
+                available_conditions,
             )
             continue
 
-        process_normal_skin(formatted_name, images, skin_datum, available_conditions)
+        process_normal_skin(
+            downloader,
+            pipeline,
+            formatted_name,
+            images,
+            skin_datum,
+            available_conditions,
+        )
+
+    downloader.wait()
+
+
+def save_unformatted_image(
+    unformatted_name: str, image_bytes: bytes, commit: Callable[[], None]
+) -> None:
+    with open(
+        f"{OUTPUT_DIRECTORY}/images/unformatted/{unformatted_name}.png", "wb+"
+    ) as f:
+        f.write(image_bytes)
+    commit()
 
 
-def download_images_from_api_data(api_data: Any) -> None:
+def download_images_from_api_data(
+    downloader: Downloader, api_data: Iterable[Any]
+) -> None:
     for count, datum in enumerate(api_data, start=1):
         formatted_name = datum["name"]
-        logging.info(f"Starting item {count}/{len(api_data)}: {formatted_name}")
+        logging.info(f"Starting item {count}: {formatted_name}")
         unformatted_name = remove_skin_name_formatting(formatted_name)
-        image_bytes = make_safe_request(datum["image"]).content
-        with open(
-            f"{OUTPUT_DIRECTORY}/images/unformatted/{unformatted_name}.png", "wb+"
-        ) as f:
-            f.write(image_bytes)
+        downloader.submit(
+            datum["image"],
+            [os.path.join("images", "unformatted", f"{unformatted_name}.png")],
+            partial(save_unformatted_image, unformatted_name),
+        )
+    downloader.wait()
 
 
-def run_for_stickers() -> None:
+def run_for_stickers(downloader: Downloader) -> None:
     logging.info("Starting stickers")
-    sticker_data = requests.get(
-        "https://bymykel.github.io/CSGO-API/api/en/stickers.json"
-    ).json()
-    download_images_from_api_data(sticker_data)
+    sticker_data = iter_json_array(stream_document(f"{CSGO_API_URL}/stickers.json"))
+    download_images_from_api_data(downloader, sticker_data)
 
 
-def run_for_containters() -> None:
+def run_for_containters(downloader: Downloader) -> None:
     logging.info("Starting containers")
-    container_data = requests.get(
-        "https://bymykel.github.io/CSGO-API/api/en/crates.json"
-    ).json()
+    container_data = iter_json_array(stream_document(f"{CSGO_API_URL}/crates.json"))
     # only include skin cases, souvenir packages and sticker capsules
-    filtered_container_data = [
+    filtered_container_data = (
         datum
         for datum in container_data
         if datum["type"] in {"Case", "Souvenir", "Sticker Capsule"}
-    ]
-    download_images_from_api_data(filtered_container_data)
+    )
+    download_images_from_api_data(downloader, filtered_container_data)
+
+
+def generate(
+    skin_data: Iterable[Any],
+    ungrouped_skin_data: Iterable[Any],
+    workers: int = 8,
+    rate: float = 4.0,
+    per_host: int = 4,
+    max_retries: int = 5,
+    timeout: float = 30.0,
+    jobs: Optional[int] = None,
+    full: bool = False,
+    symlinks: bool = True,
+) -> None:
+    """
+    Download and write the skin images, saving the manifest even on failure.
+    Without `symlinks`, the names are written to the alias index instead.
+    """
+    global alias_index
+    # raw images removed by the last deduplication live on in their blobs
+    previous_index = AliasIndex.load()
+    if not symlinks:
+        alias_index = AliasIndex(blobs=previous_index.blobs)
+    manifest = (
+        ImageManifest({})
+        if full
+        else ImageManifest.load(resolve=previous_index.resolve_raw)
+    )
+    downloader = Downloader(
+        user_agents,
+        workers=workers,
+        rate=rate,
+        burst=per_host,
+        per_host=per_host,
+        max_retries=max_retries,
+        timeout=timeout,
+        manifest=manifest,
+    )
+    pipeline = ImagePipeline(jobs, manifest=manifest)
+    try:
+        with recorder.span("process"):
+            run_for_skins(downloader, pipeline, skin_data, ungrouped_skin_data)
+        # run_for_stickers(downloader)
+        # run_for_containters(downloader)
+    finally:
+        try:
+            try:
+                downloader.close()
+            finally:
+                pipeline.close()
+        finally:
+            manifest.save()
+            index, alias_index = alias_index, None
+    # a partial index would drop the names it did not get to
+    if index is not None:
+        index.save()
 
 
 if __name__ == "__main__":
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        prog="gen_images",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-w", "--workers", type=int, default=8, help="concurrent download threads"
+    )
+    parser.add_argument(
+        "-r", "--rate", type=float, default=4.0, help="maximum requests per second"
+    )
+    parser.add_argument(
+        "--per-host", type=int, default=4, help="maximum concurrent requests per host"
+    )
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=5,
+        help="retries on connection errors, timeouts and 429/5xx responses",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30.0, help="seconds to wait for a response"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="image encoding processes (default: available cores)",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="ignore the download manifest and regenerate every image",
+    )
+    parser.add_argument(
+        "--no-symlinks",
+        action="store_true",
+        help="write the image names to the alias index instead of symlinking them",
+    )
+    fetch.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    fetch.configure(args)
     # directories
-    os.makedirs(f"{OUTPUT_DIRECTORY}/images/raw", exist_ok=True)
-    os.makedirs(f"{OUTPUT_DIRECTORY}/images/unformatted", exist_ok=True)
-    os.makedirs(f"{OUTPUT_DIRECTORY}/images/preview", exist_ok=True)
+    make_image_directories()
     os.makedirs(LOG_DIRECTORY, exist_ok=True)
 
     # logging
@@ -297,7 +422,16 @@ if __name__ == "__main__":
             logging.StreamHandler(),
         ],
     )
-    run_for_skins()
-    # run_for_skins()
-    # run_for_stickers()
-    # run_for_containters()
+    instrumentation.configure(args)
+    generate(
+        iter_json_array(stream_document(f"{CSGO_API_URL}/skins.json")),
+        iter_json_array(stream_document(f"{CSGO_API_URL}/skins_not_grouped.json")),
+        workers=args.workers,
+        rate=args.rate,
+        per_host=args.per_host,
+        max_retries=args.max_retries,
+        timeout=args.timeout,
+        jobs=args.jobs,
+        full=args.full,
+        symlinks=not args.no_symlinks,
+    )
@@ -5,19 +5,25 @@ Generate all metadata for CS2 skins and stickers
 import os
 import re
 import sys
-import json
-import requests
+import logging
 import argparse
-from typing import NamedTuple, Any
-from constants import OUTPUT_DIRECTORY, DEFAULT_ASSET_DOMAIN
+from typing import NamedTuple, Any, Iterable, Optional
+import fetch
+import instrumentation
+from constants import OUTPUT_DIRECTORY, DEFAULT_ASSET_DOMAIN, CSGO_API_URL
 from spacecases_common import (
-    remove_skin_name_formatting,
     SkinMetadatum,
     StickerMetadatum,
     Rarity,
 )
 from constants import VANILLA_KNIVES
+from names import remove_skin_name_formatting, load_name_index, write_name_index
+from output import write_json
+from instrumentation import recorder
+from sharding import map_shards
+from streaming import iter_json_object, stream_document
 from util import Condition, create_image_url, get_rarity_from_string
+from aliases import AliasIndex
 
 
 class Result(NamedTuple):
@@ -25,17 +31,34 @@ class Result(NamedTuple):
     sticker_metadata: dict[str, StickerMetadatum]
 
 
+class Context(NamedTuple):
+    """What processing an item needs besides its upstream record."""
+
+    asset_domain: str
+    aliases: Optional[AliasIndex] = None
+
+
+# the context of the shards processed by this process, set by `init_worker`
+worker_context: Optional[Context] = None
+
+
 def process_skin_json(
-    metadata: dict[str, SkinMetadatum], datum: Any, asset_domain: str
+    metadata: dict[str, SkinMetadatum],
+    datum: Any,
+    asset_domain: str,
+    aliases: Optional[AliasIndex] = None,
 ) -> None:
     if datum["name"] in VANILLA_KNIVES:
-        process_vanilla_knife(metadata, datum, asset_domain)
+        process_vanilla_knife(metadata, datum, asset_domain, aliases)
     else:
-        process_non_vanilla_knife(metadata, datum, asset_domain)
+        process_non_vanilla_knife(metadata, datum, asset_domain, aliases)
 
 
 def process_vanilla_knife(
-    metadata: dict[str, SkinMetadatum], datum: Any, asset_domain: str
+    metadata: dict[str, SkinMetadatum],
+    datum: Any,
+    asset_domain: str,
+    aliases: Optional[AliasIndex] = None,
 ) -> None:
     formatted_name_no_wear = datum["name"]
     for condition in Condition:
@@ -45,7 +68,7 @@ def process_vanilla_knife(
         min_float = 0.0
         max_float = 1.0
         description = None
-        image_url = create_image_url(unformatted_name, asset_domain)
+        image_url = create_image_url(unformatted_name, asset_domain, aliases=aliases)
         metadata[unformatted_name] = SkinMetadatum(
             formatted_name=formatted_name,
             condition=condition,
@@ -59,7 +82,10 @@ def process_vanilla_knife(
 
 
 def process_non_vanilla_knife(
-    metadata: dict[str, SkinMetadatum], datum: Any, asset_domain: str
+    metadata: dict[str, SkinMetadatum],
+    datum: Any,
+    asset_domain: str,
+    aliases: Optional[AliasIndex] = None,
 ) -> None:
     # name
     formatted_name = datum["name"]
@@ -94,7 +120,7 @@ def process_non_vanilla_knife(
     else:
         description = None
     # image url
-    image_url = create_image_url(unformatted_name, asset_domain)
+    image_url = create_image_url(unformatted_name, asset_domain, aliases=aliases)
     # insert
     skin_datum = SkinMetadatum(
         formatted_name=formatted_name,
@@ -110,28 +136,91 @@ def process_non_vanilla_knife(
 
 
 def process_sticker_json(
-    metadata: dict[str, StickerMetadatum], datum: Any, asset_domain: str
+    metadata: dict[str, StickerMetadatum],
+    datum: Any,
+    asset_domain: str,
+    aliases: Optional[AliasIndex] = None,
 ) -> None:
     formatted_name = datum["name"]
     unformatted_name = remove_skin_name_formatting(formatted_name)
     rarity = get_rarity_from_string(datum["rarity"]["id"])
-    image_url = create_image_url(unformatted_name, asset_domain)
+    image_url = create_image_url(unformatted_name, asset_domain, aliases=aliases)
     metadata[unformatted_name] = StickerMetadatum(
         formatted_name=formatted_name, rarity=rarity, price=0, image_url=image_url
     )
 
 
-def run(api_data: Any, asset_domain: str) -> Result:
+def run(
+    api_data: Iterable[tuple[str, Any]],
+    asset_domain: str,
+    aliases: Optional[AliasIndex] = None,
+) -> Result:
     skin_metadata: dict[str, SkinMetadatum] = {}
     sticker_metadata: dict[str, StickerMetadatum] = {}
-    for name, datum in api_data.items():
+    for name, datum in api_data:
         if "skin" in name:
-            process_skin_json(skin_metadata, datum, asset_domain)
+            process_skin_json(skin_metadata, datum, asset_domain, aliases)
         elif "sticker" in name:
-            process_sticker_json(sticker_metadata, datum, asset_domain)
+            process_sticker_json(sticker_metadata, datum, asset_domain, aliases)
     return Result(skin_metadata, sticker_metadata)
 
 
+def init_worker(context: Context) -> None:
+    """
+    Give this process the context of the shards it processes, so the alias
+    index is sent to each worker once rather than with every shard.
+    """
+    global worker_context
+    worker_context = context
+
+
+def process_shard(
+    shard: list[tuple[str, Any]],
+) -> tuple[dict[str, Any], dict[str, Any]]:
+    """Run a shard of the upstream records and serialise its metadata."""
+    assert worker_context is not None
+    skin_metadata, sticker_metadata = run(shard, *worker_context)
+    return (
+        {key: value.model_dump() for key, value in skin_metadata.items()},
+        {key: value.model_dump() for key, value in sticker_metadata.items()},
+    )
+
+
+def generate(
+    api_data: Iterable[tuple[str, Any]],
+    asset_domain: str,
+    jobs: int = 1,
+    aliases: Optional[AliasIndex] = None,
+) -> None:
+    """
+    Generate and write the skin and sticker metadata files. With `aliases`,
+    image URLs point at the files the alias index resolves names to.
+    """
+    context = Context(asset_domain, aliases)
+    # a single job runs the shards in this process
+    init_worker(context)
+    # reuse the names normalised by the previous run
+    load_name_index()
+    # run, merging the shards in upstream order
+    skin_metadata: dict[str, Any] = {}
+    sticker_metadata: dict[str, Any] = {}
+    with recorder.span("process"):
+        for skin_shard, sticker_shard in map_shards(
+            process_shard,
+            api_data,
+            jobs,
+            initializer=init_worker,
+            initargs=(context,),
+        ):
+            skin_metadata.update(skin_shard)
+            sticker_metadata.update(sticker_shard)
+    recorder.count("records", len(skin_metadata), kind="skin")
+    recorder.count("records", len(sticker_metadata), kind="sticker")
+    # output
+    write_json("skin_metadata.json", skin_metadata)
+    write_json("sticker_metadata.json", sticker_metadata)
+
+
 if __name__ == "__main__":
     # argument parsing
     parser = argparse.ArgumentParser(
@@ -143,25 +232,37 @@ if __name__ == "__main__":
     parser.add_argument(
         "-d", "--domain", default=DEFAULT_ASSET_DOMAIN, help="asset domain URL"
     )
+    parser.add_argument(
+        "-s",
+        "--source",
+        default=f"{CSGO_API_URL}/all.json",
+        help="URL or local path of the CSGO-API all.json document",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="processes to generate the metadata on, in shards of upstream records",
+    )
+    parser.add_argument(
+        "--aliases",
+        action="store_true",
+        help="point image URLs at the files named by the image alias index",
+    )
+    fetch.add_arguments(parser)
+    instrumentation.add_arguments(parser)
     args = parser.parse_args()
+    fetch.configure(args)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    instrumentation.configure(args)
     # folder structure
     os.makedirs(OUTPUT_DIRECTORY, exist_ok=True)
-    # get api data
-    api_data = requests.get("https://bymykel.github.io/CSGO-API/api/en/all.json").json()
-    # run
-    skin_metadata, sticker_metadata = run(api_data, args.domain)
-    # output
-    with open(f"{OUTPUT_DIRECTORY}/skin_metadata.json", "w+", encoding="utf-8") as f:
-        json.dump(
-            {key: value.model_dump() for key, value in skin_metadata.items()},
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
-    with open(f"{OUTPUT_DIRECTORY}/sticker_metadata.json", "w+", encoding="utf-8") as f:
-        json.dump(
-            {key: value.model_dump() for key, value in sticker_metadata.items()},
-            f,
-            ensure_ascii=False,
-            indent=4,
-        )
+    # stream api data
+    api_data = iter_json_object(stream_document(args.source))
+    # run and output
+    aliases = AliasIndex.load() if args.aliases else None
+    generate(api_data, args.domain, args.jobs, aliases)
+    write_name_index()
@@ -0,0 +1,253 @@
+"""
+Process pool stage that decodes downloaded skin images and writes their variants
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+from io import BytesIO
+from functools import partial
+from typing import Callable, NamedTuple, Optional
+from concurrent.futures import Future, ProcessPoolExecutor
+from PIL import Image, ImageOps
+from constants import OUTPUT_DIRECTORY
+from manifest import ImageManifest
+from instrumentation import recorder
+
+BORDER_COLOURS = {
+    "souvenir": "#CF6A32",
+    "stattrak": "#FFD700",
+}
+
+
+def get_border_colour(name: str) -> Optional[str]:
+    for prefix, colour in BORDER_COLOURS.items():
+        if name.startswith(prefix):
+            return colour
+    return None
+
+
+# edge lengths in pixels of the thumbnails, `None` keeps the original size
+VARIANT_SIZES: list[Optional[int]] = [64, 128, 256, None]
+# encoder settings per format, only formats this Pillow build can write are used
+Image.init()
+VARIANT_FORMATS = {
+    image_format: options
+    for image_format, options in {
+        "webp": {"quality": 85, "method": 6},
+        "avif": {"quality": 60, "speed": 4},
+    }.items()
+    if image_format.upper() in Image.SAVE
+}
+
+
+class ImageVariant(NamedTuple):
+    path: str
+    size: int
+    width: int
+    height: int
+
+
+def variant_directory(size: Optional[int]) -> str:
+    return "full" if size is None else str(size)
+
+
+def image_path(
+    directory: str, name: str, size: Optional[int] = None, image_format: str = "png"
+) -> str:
+    """Path, relative to `OUTPUT_DIRECTORY`, of one image of `name`."""
+    if image_format == "png":
+        return os.path.join("images", directory, f"{name}.png")
+    return os.path.join(
+        "images", directory, variant_directory(size), f"{name}.{image_format}"
+    )
+
+
+def image_paths(directory: str, name: str) -> list[str]:
+    """
+    Paths, relative to `OUTPUT_DIRECTORY`, of the full size PNG of `name` in
+    `images/<directory>` followed by every variant of it.
+    """
+    paths = [image_path(directory, name)]
+    for size in VARIANT_SIZES:
+        for image_format in VARIANT_FORMATS:
+            paths.append(image_path(directory, name, size, image_format))
+    return paths
+
+
+def make_image_directories() -> None:
+    for directory in ["raw", "unformatted", "preview"]:
+        os.makedirs(os.path.join(OUTPUT_DIRECTORY, "images", directory), exist_ok=True)
+        for size in VARIANT_SIZES:
+            os.makedirs(
+                os.path.join(
+                    OUTPUT_DIRECTORY, "images", directory, variant_directory(size)
+                ),
+                exist_ok=True,
+            )
+
+
+def encode_variants(
+    image: Image.Image, png_bytes: Optional[bytes] = None
+) -> list[tuple[bytes, int, int]]:
+    """
+    Encode `image` in the order of `image_paths`: as PNG (reusing `png_bytes`
+    if given), then at every size in every variant format.
+    """
+    if png_bytes is None:
+        buffer = BytesIO()
+        image.save(buffer, format="PNG")
+        png_bytes = buffer.getvalue()
+    encoded = [(png_bytes, image.width, image.height)]
+    for size in VARIANT_SIZES:
+        resized = image
+        if size is not None:
+            resized = image.copy()
+            resized.thumbnail((size, size), Image.Resampling.LANCZOS)
+        for image_format, options in VARIANT_FORMATS.items():
+            buffer = BytesIO()
+            resized.save(buffer, format=image_format.upper(), **options)
+            encoded.append((buffer.getvalue(), resized.width, resized.height))
+    return encoded
+
+
+def save_skin_images(names: list[str], image_bytes: bytes) -> list[ImageVariant]:
+    """
+    Write the raw image and its variants for every name, decoding
+    `image_bytes` once and encoding each distinct StatTrak/Souvenir border
+    once. Returns the size and dimensions of every file written.
+    """
+    image = Image.open(BytesIO(image_bytes))
+    image.load()
+    encoded: dict[Optional[str], list[tuple[bytes, int, int]]] = {}
+    written = []
+    for name in names:
+        colour = get_border_colour(name)
+        if colour not in encoded:
+            if colour is None:
+                encoded[colour] = encode_variants(image, image_bytes)
+            else:
+                encoded[colour] = encode_variants(
+                    ImageOps.expand(image, border=3, fill=colour)
+                )
+        for path, (data, width, height) in zip(
+            image_paths("raw", name), encoded[colour]
+        ):
+            full_path = os.path.join(OUTPUT_DIRECTORY, path)
+            # replace links to deduplicated blobs instead of writing through them
+            if os.path.islink(full_path):
+                os.remove(full_path)
+            with open(full_path, "wb+") as f:
+                f.write(data)
+            written.append(ImageVariant(path, len(data), width, height))
+    return written
+
+
+def encode_job(
+    names: list[str], image_bytes: bytes
+) -> tuple[list[ImageVariant], float]:
+    """`save_skin_images` on a worker, along with how long it took."""
+    start = time.perf_counter()
+    written = save_skin_images(names, image_bytes)
+    return written, time.perf_counter() - start
+
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class ImageJob(NamedTuple):
+    url: str
+    names: list[str]
+    image_bytes: bytes
+    # records the download in the manifest once the images are written
+    commit: Callable[[], None]
+
+
+class ImagePipeline:
+    """
+    Encode downloaded images on a process pool.
+
+    Download threads `put` jobs on a bounded queue, blocking when the encoders
+    fall behind. A feeder thread hands jobs to the pool, keeping at most
+    `2 * workers` of them in flight. Once a job's files are written, its
+    `commit` is called and the size and dimensions of every file are recorded
+    in `manifest`, if given. Failed jobs are not committed.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        queue_size: int = 64,
+        manifest: Optional[ImageManifest] = None,
+    ) -> None:
+        self.workers = workers or available_cores()
+        self.manifest = manifest
+        self.jobs: queue.Queue[Optional[ImageJob]] = queue.Queue(maxsize=queue_size)
+        self.in_flight = threading.BoundedSemaphore(2 * self.workers)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.errors: list[BaseException] = []
+        self.errors_lock = threading.Lock()
+        self.feeder = threading.Thread(target=self._feed, daemon=True)
+        self.feeder.start()
+
+    def _on_done(
+        self, job: ImageJob, future: Future[tuple[list[ImageVariant], float]]
+    ) -> None:
+        self.in_flight.release()
+        exception = future.exception()
+        if exception is not None:
+            logging.error(f"Image encoding failed: {exception}")
+            with self.errors_lock:
+                self.errors.append(exception)
+            return
+        written, seconds = future.result()
+        recorder.record("encode", seconds)
+        recorder.count("images_encoded", len(written))
+        recorder.count("written_bytes", sum(variant.size for variant in written))
+        job.commit()
+        if self.manifest is not None:
+            self.manifest.record_variants(
+                job.url,
+                {
+                    variant.path: {
+                        "size": variant.size,
+                        "width": variant.width,
+                        "height": variant.height,
+                    }
+                    for variant in written
+                },
+            )
+
+    def _feed(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            self.in_flight.acquire()
+            future = self.executor.submit(encode_job, job.names, job.image_bytes)
+            future.add_done_callback(partial(self._on_done, job))
+
+    def put(
+        self,
+        url: str,
+        names: list[str],
+        image_bytes: bytes,
+        commit: Callable[[], None],
+    ) -> None:
+        self.jobs.put(ImageJob(url, names, image_bytes, commit))
+
+    def close(self) -> None:
+        """Wait for every queued job to be written, raising if any failed."""
+        self.jobs.put(None)
+        self.feeder.join()
+        self.executor.shutdown(wait=True)
+        if self.errors:
+            raise RuntimeError(f"{len(self.errors)} images failed to encode")
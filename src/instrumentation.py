@@ -0,0 +1,331 @@
+"""
+Time the stages of a run, count its requests and bytes, and report them as
+JSON or OpenMetrics, at exit or live over HTTP
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import signal
+import logging
+import argparse
+import resource
+import threading
+import tracemalloc
+from typing import Any, Iterable, Iterator, Optional, TypeVar
+from types import FrameType
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from constants import LOG_DIRECTORY
+
+T = TypeVar("T")
+
+METRIC_PREFIX = "spacecases"
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+# reports with these extensions are written as OpenMetrics, others as JSON
+OPENMETRICS_EXTENSIONS = (".prom", ".txt")
+# ru_maxrss is in bytes on macOS and in kibibytes elsewhere
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def peak_rss() -> int:
+    """The highest resident set size of this process so far, in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+
+class SpanStats:
+    """
+    Every run of one span. `peak_rss` is the process's resident high-water
+    mark when the span last ended, so the first span to raise it stands out;
+    `peak_traced_memory` is the highest traced allocation while the span was
+    open, and only measured with `--trace-memory`.
+    """
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.peak_rss = 0
+        self.peak_traced_memory = 0
+
+    def record(self, seconds: float, peak_traced_memory: int = 0) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.peak_rss = max(self.peak_rss, peak_rss())
+        self.peak_traced_memory = max(self.peak_traced_memory, peak_traced_memory)
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "seconds": self.seconds,
+            "max_seconds": self.max_seconds,
+            "peak_rss": self.peak_rss,
+            "peak_traced_memory": self.peak_traced_memory,
+        }
+
+
+class OpenSpan:
+    """The traced memory peak seen so far by a span that has not ended."""
+
+    def __init__(self) -> None:
+        self.peak = 0
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name: str, labels: Iterable[tuple[str, str]], value: float) -> str:
+    label_text = ",".join(
+        f'{key}="{escape_label_value(label)}"' for key, label in labels
+    )
+    if label_text:
+        name = f"{name}{{{label_text}}}"
+    return f"{name} {int(value) if float(value).is_integer() else value}"
+
+
+class Recorder:
+    """
+    Span timings and counters of this process.
+
+    Spans nest per thread: a span entered while another is open on the same
+    thread is recorded as `outer/inner`, and its time is included in the
+    outer span's. Work done in worker processes is only seen through the
+    spans around it in this process, or through `record`.
+    """
+
+    def __init__(self) -> None:
+        self.started = time.time()
+        self.trace_memory = False
+        self.spans: dict[str, SpanStats] = {}
+        # (name, sorted labels) -> value
+        self.counters: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+        self.open: set[OpenSpan] = set()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self) -> list[str]:
+        stack: list[str] = self.local.__dict__.setdefault("stack", [])
+        return stack
+
+    def _update_peaks(self) -> None:
+        """Charge the traced peak since the last update to every open span."""
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        for opened in self.open:
+            opened.peak = max(opened.peak, peak)
+
+    def _stats(self, path: str) -> SpanStats:
+        stats = self.spans.get(path)
+        if stats is None:
+            stats = self.spans[path] = SpanStats()
+        return stats
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        """Time the body of the `with` statement as the span `name`."""
+        stack = self._stack()
+        stack.append(name)
+        path = "/".join(stack)
+        opened = OpenSpan()
+        if self.trace_memory:
+            with self.lock:
+                self._update_peaks()
+                self.open.add(opened)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                if self.trace_memory:
+                    self._update_peaks()
+                    self.open.discard(opened)
+                self._stats(path).record(seconds, opened.peak)
+
+    def record(self, name: str, seconds: float) -> None:
+        """Record a run of the span `name` timed elsewhere, such as in a worker."""
+        path = "/".join([*self._stack(), name])
+        with self.lock:
+            self._stats(path).record(seconds)
+
+    def iterate(self, name: str, iterable: Iterable[T]) -> Iterator[T]:
+        """Yield from `iterable`, timing the production of every item as `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.span(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, name: str, value: float = 1, **labels: str) -> None:
+        """Add `value` to the counter `name` with `labels`."""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def report(self) -> dict[str, Any]:
+        with self.lock:
+            return {
+                "started_at": self.started,
+                "seconds": time.time() - self.started,
+                "peak_rss": peak_rss(),
+                "spans": {
+                    path: stats.to_json() for path, stats in sorted(self.spans.items())
+                },
+                "counters": [
+                    {"name": name, "labels": dict(labels), "value": value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+            }
+
+    def openmetrics(self) -> str:
+        """The report in the OpenMetrics text format."""
+        report = self.report()
+        lines = []
+
+        def family(
+            name: str, kind: str, samples: list[tuple[list[tuple[str, str]], float]]
+        ) -> None:
+            metric = f"{METRIC_PREFIX}_{name}"
+            lines.append(f"# TYPE {metric} {kind}")
+            sample_name = f"{metric}_total" if kind == "counter" else metric
+            lines.extend(
+                format_sample(sample_name, labels, value) for labels, value in samples
+            )
+
+        family("run_seconds", "gauge", [([], report["seconds"])])
+        family("peak_rss_bytes", "gauge", [([], report["peak_rss"])])
+        spans = report["spans"].items()
+        for name, kind, key in [
+            ("span_calls", "counter", "calls"),
+            ("span_seconds", "counter", "seconds"),
+            ("span_max_seconds", "gauge", "max_seconds"),
+            ("span_peak_rss_bytes", "gauge", "peak_rss"),
+            *(
+                [("span_peak_traced_memory_bytes", "gauge", "peak_traced_memory")]
+                if self.trace_memory
+                else []
+            ),
+        ]:
+            family(
+                name, kind, [([("span", path)], stats[key]) for path, stats in spans]
+            )
+        counters: dict[str, list[tuple[list[tuple[str, str]], float]]] = {}
+        for counter in report["counters"]:
+            counters.setdefault(counter["name"], []).append(
+                (list(counter["labels"].items()), counter["value"])
+            )
+        for name, samples in counters.items():
+            family(name, "counter", samples)
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+recorder = Recorder()
+# where `save_report` writes, set by `configure`
+report_path: Optional[str] = None
+
+
+def write_report(path: str) -> None:
+    """Write the report to `path`, as OpenMetrics or JSON by its extension."""
+    if path.endswith(OPENMETRICS_EXTENSIONS):
+        body = recorder.openmetrics().encode()
+    else:
+        body = json.dumps(recorder.report(), indent=4).encode()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # `output` records its writes here, so this module cannot use it
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(body)
+    os.replace(tmp_path, path)
+
+
+def save_report() -> None:
+    """Write the report to the configured path, if there is one."""
+    if report_path is None:
+        return
+    write_report(report_path)
+    logging.debug(f"Wrote metrics to {report_path}")
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format: str, *args: object) -> None:
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def do_GET(self) -> None:
+        if self.path == "/metrics":
+            body = recorder.openmetrics().encode()
+            content_type = OPENMETRICS_CONTENT_TYPE
+        elif self.path == "/metrics.json":
+            body = json.dumps(recorder.report(), indent=4).encode()
+            content_type = "application/json"
+        else:
+            self.send_response(HTTPStatus.NOT_FOUND)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_live_server(host: str, port: int) -> ThreadingHTTPServer:
+    """Serve the live report at `/metrics` and `/metrics.json` on a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving live metrics on {host}:{port}")
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    metrics = parser.add_argument_group("metrics")
+    metrics.add_argument(
+        "--metrics",
+        default=os.path.join(LOG_DIRECTORY, f"{parser.prog}_metrics.json"),
+        help="where to write the stage timings and counters at exit, as "
+        f"OpenMetrics if it ends in {' or '.join(OPENMETRICS_EXTENSIONS)}",
+    )
+    metrics.add_argument(
+        "--metrics-port",
+        type=int,
+        default=None,
+        help="serve live metrics on this port at /metrics and /metrics.json",
+    )
+    metrics.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="address to serve live metrics on",
+    )
+    metrics.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="also measure the peak traced memory of every stage, which is slower",
+    )
+
+
+def exit_on_signal(signum: int, frame: Optional[FrameType]) -> None:
+    sys.exit(128 + signum)
+
+
+def configure(args: argparse.Namespace) -> None:
+    global report_path
+    report_path = args.metrics
+    atexit.register(save_report)
+    # exit normally when stopped, so the report is still written
+    signal.signal(signal.SIGTERM, exit_on_signal)
+    if args.trace_memory:
+        tracemalloc.start()
+        recorder.trace_memory = True
+    if args.metrics_port is not None:
+        start_live_server(args.metrics_host, args.metrics_port)
@@ -0,0 +1,112 @@
+"""
+Persisted manifest of downloaded images, used to make image generation incremental
+"""
+
+import os
+import json
+import threading
+from typing import Callable, NamedTuple, Optional
+from constants import OUTPUT_DIRECTORY
+
+MANIFEST_PATH = os.path.join(OUTPUT_DIRECTORY, "image_manifest.json")
+
+
+class ManifestEntry(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    sha256: str
+    files: list[str]
+    # byte size, width and height of each file, by path, once recorded
+    variants: Optional[dict[str, dict[str, int]]] = None
+
+
+class ImageManifest:
+    """
+    Map of source image URL to its validators, content hash and the files
+    (relative to `OUTPUT_DIRECTORY`) that were generated from it.
+
+    `resolve` maps a generated file to the file now holding it, such as
+    `AliasIndex.resolve_raw` for raw images that deduplication moved into
+    blobs.
+    """
+
+    def __init__(
+        self,
+        entries: dict[str, ManifestEntry],
+        resolve: Optional[Callable[[str], str]] = None,
+    ) -> None:
+        self.entries = entries
+        self.resolve = resolve
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(
+        cls,
+        path: str = MANIFEST_PATH,
+        resolve: Optional[Callable[[str], str]] = None,
+    ) -> "ImageManifest":
+        try:
+            with open(path, encoding="utf-8") as f:
+                raw = json.load(f)
+        except FileNotFoundError:
+            return cls({}, resolve)
+        return cls({url: ManifestEntry(**entry) for url, entry in raw.items()}, resolve)
+
+    def save(self, path: str = MANIFEST_PATH) -> None:
+        with self.lock:
+            data = {url: entry._asdict() for url, entry in sorted(self.entries.items())}
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+
+    def get(self, url: str) -> Optional[ManifestEntry]:
+        with self.lock:
+            return self.entries.get(url)
+
+    def is_complete(self, url: str, files: list[str]) -> bool:
+        """Whether all of `files` were generated from `url` and still exist."""
+        entry = self.get(url)
+        if entry is None or not set(files).issubset(entry.files):
+            return False
+        if self.resolve is not None:
+            files = [self.resolve(f) for f in files]
+        return all(os.path.exists(os.path.join(OUTPUT_DIRECTORY, f)) for f in files)
+
+    def conditional_headers(self, url: str, files: list[str]) -> dict[str, str]:
+        """Headers for a conditional GET, empty if the outputs must be regenerated."""
+        if not self.is_complete(url, files):
+            return {}
+        entry = self.get(url)
+        assert entry is not None
+        headers = {}
+        if entry.etag is not None:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified is not None:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def record(
+        self,
+        url: str,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        sha256: str,
+        files: list[str],
+    ) -> None:
+        with self.lock:
+            previous = self.entries.get(url)
+            variants = None if previous is None else previous.variants
+            self.entries[url] = ManifestEntry(
+                etag, last_modified, sha256, files, variants
+            )
+
+    def record_variants(self, url: str, variants: dict[str, dict[str, int]]) -> None:
+        """
+        Record the byte size and dimensions of the files generated from `url`,
+        once its download is recorded.
+        """
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries[url] = entry._replace(variants=variants)
@@ -0,0 +1,304 @@
+"""
+Fetch item prices from several markets concurrently into one price frame
+"""
+
+import json
+import time
+import random
+import asyncio
+import logging
+import numpy as np
+import numpy.typing as npt
+import fetch
+from typing import Any, Callable, NamedTuple, Optional
+from concurrent.futures import Future, ThreadPoolExecutor
+from constants import SKINPORT_ITEMS_URL
+from instrumentation import recorder
+
+# Skinport caches the items endpoint for 5 minutes
+SKINPORT_TTL = 5 * 60
+DEFAULT_TIMEOUT = 30.0
+# fraction of the total weight cut from each end by the trimmed mean
+DEFAULT_TRIM = 0.25
+
+# requests outlive their timeout, so they get threads of their own rather
+# than the event loop's default executor, which is joined when the loop closes
+_executor = ThreadPoolExecutor(thread_name_prefix="market")
+
+
+def skinport_headers() -> dict[str, str]:
+    with open("user_agents.txt") as f:
+        user_agents = [line.strip() for line in f.readlines()]
+    return {
+        "User-Agent": random.choice(user_agents),
+        "Accept-Encoding": "br, gzip, deflate",
+        "Accept": "*/*",
+    }
+
+
+class PriceFrame(NamedTuple):
+    """
+    Prices in columns, one row per listing: the index of the item's market
+    name in `names`, the index of the market in `markets`, the price in
+    cents and the weight of the market.
+    """
+
+    markets: list[str]
+    names: list[str]
+    name_id: npt.NDArray[np.int32]
+    market: npt.NDArray[np.int32]
+    price: npt.NDArray[np.int64]
+    weight: npt.NDArray[np.float64]
+
+    @classmethod
+    def empty(cls) -> "PriceFrame":
+        return cls(
+            [],
+            [],
+            np.empty(0, np.int32),
+            np.empty(0, np.int32),
+            np.empty(0, np.int64),
+            np.empty(0, np.float64),
+        )
+
+    @classmethod
+    def concat(cls, frames: list["PriceFrame"]) -> "PriceFrame":
+        """Stack `frames`, merging their names and renumbering their markets."""
+        if not frames:
+            return cls.empty()
+        markets: list[str] = []
+        name_ids: dict[str, int] = {}
+        market_columns = []
+        name_id_columns = []
+        for frame in frames:
+            market_columns.append(frame.market + len(markets))
+            markets.extend(frame.markets)
+            remap = np.array(
+                [name_ids.setdefault(name, len(name_ids)) for name in frame.names],
+                np.int32,
+            )
+            name_id_columns.append(remap[frame.name_id])
+        return cls(
+            markets,
+            list(name_ids),
+            np.concatenate(name_id_columns).astype(np.int32),
+            np.concatenate(market_columns).astype(np.int32),
+            np.concatenate([frame.price for frame in frames]),
+            np.concatenate([frame.weight for frame in frames]),
+        )
+
+
+class Market:
+    """
+    A market publishing a JSON list of listings. Each listing has the market
+    name of an item under `name_key` and its price in dollars under
+    `price_key`; `items_key` names the list if the document wraps it.
+
+    `fetch` gives up after `timeout` seconds and returns the last prices it
+    got instead. Requests that run over keep going, and their prices are
+    used by the next refresh. The market is requested at most once every
+    `min_interval` seconds. With a `stub`, the listings are read from that
+    local JSON file instead of the market.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        url: str,
+        headers: Optional[Callable[[], dict[str, str]]] = None,
+        ttl: Optional[float] = None,
+        name_key: str = "market_hash_name",
+        price_key: str = "suggested_price",
+        items_key: Optional[str] = None,
+        weight: float = 1.0,
+        timeout: float = DEFAULT_TIMEOUT,
+        min_interval: float = 0.0,
+        stub: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self.url = url
+        self.headers = headers
+        self.ttl = ttl
+        self.name_key = name_key
+        self.price_key = price_key
+        self.items_key = items_key
+        self.weight = weight
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.stub = stub
+        self.last: Optional[PriceFrame] = None
+        self._request: Optional[Future[PriceFrame]] = None
+        self._requested_at = -float("inf")
+
+    def load(self) -> Any:
+        """The market's listings document, from the stub or the upstream cache."""
+        if self.stub is not None:
+            with open(self.stub, "rb") as f:
+                return json.load(f)
+        headers = None if self.headers is None else self.headers()
+        return fetch.upstream.get_json(self.url, headers, self.ttl)
+
+    def to_frame(self, data: Any) -> PriceFrame:
+        """
+        The priced listings in `data`. Prices are converted to cents in bulk,
+        rounding to the nearest cent.
+        """
+        listings = data if self.items_key is None else data[self.items_key]
+        # unpriced listings parse as NaN
+        dollars = np.array(
+            [listing.get(self.price_key) for listing in listings], np.float64
+        )
+        priced = ~np.isnan(dollars)
+        name_ids: dict[str, int] = {}
+        name_id = np.array(
+            [
+                name_ids.setdefault(listing[self.name_key], len(name_ids))
+                for listing in listings
+            ],
+            np.int32,
+        )
+        return PriceFrame(
+            [self.name],
+            list(name_ids),
+            name_id[priced],
+            np.zeros(np.count_nonzero(priced), np.int32),
+            np.rint(dollars[priced] * 100).astype(np.int64),
+            np.full(np.count_nonzero(priced), self.weight),
+        )
+
+    def _request_frame(self) -> PriceFrame:
+        with recorder.span("markets"), recorder.span(self.name):
+            with recorder.span("fetch"):
+                data = self.load()
+            with recorder.span("parse"):
+                frame = self.to_frame(data)
+        recorder.count("market_listings", len(frame.price), market=self.name)
+        self.last = frame
+        return frame
+
+    async def fetch(self) -> PriceFrame:
+        """This market's prices, or its last prices if it is slow or failing."""
+        if self._request is None or self._request.done():
+            if time.monotonic() - self._requested_at < self.min_interval:
+                if self.last is not None:
+                    return self.last
+            self._request = _executor.submit(self._request_frame)
+            self._requested_at = time.monotonic()
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(asyncio.wrap_future(self._request)), self.timeout
+            )
+        except TimeoutError:
+            logging.warning(f"{self.name} timed out after {self.timeout} s")
+        except Exception as e:
+            logging.warning(f"Fetching prices from {self.name} failed: {e}")
+        recorder.count("market_fallbacks", market=self.name)
+        if self.last is None:
+            return PriceFrame.empty()
+        logging.warning(f"Using the last prices from {self.name}")
+        return self.last
+
+
+MARKETS = {
+    "skinport": Market("skinport", SKINPORT_ITEMS_URL, skinport_headers, SKINPORT_TTL),
+}
+
+
+async def fetch_frames(markets: list[Market]) -> list[PriceFrame]:
+    return await asyncio.gather(*(market.fetch() for market in markets))
+
+
+def fetch_prices(markets: list[Market]) -> PriceFrame:
+    """Fetch every market concurrently and stack their prices."""
+    with recorder.span("fetch"):
+        return PriceFrame.concat(asyncio.run(fetch_frames(markets)))
+
+
+# an aggregation maps the group of every price, the prices, their weights,
+# the number of groups and the trim fraction to one value per group
+Aggregation = Callable[
+    [
+        npt.NDArray[np.intp],
+        npt.NDArray[np.int64],
+        npt.NDArray[np.float64],
+        int,
+        float,
+    ],
+    npt.NDArray[np.float64],
+]
+
+
+def group_mean(
+    group: npt.NDArray[np.intp],
+    price: npt.NDArray[np.int64],
+    weight: npt.NDArray[np.float64],
+    groups: int,
+    trim: float = DEFAULT_TRIM,
+) -> npt.NDArray[np.float64]:
+    """Mean price of every group weighted by `weight`, 0 for empty groups."""
+    totals = np.bincount(group, weights=weight, minlength=groups)
+    sums = np.bincount(group, weights=price * weight, minlength=groups)
+    return np.divide(sums, totals, out=np.zeros(groups), where=totals > 0)
+
+
+def group_median(
+    group: npt.NDArray[np.intp],
+    price: npt.NDArray[np.int64],
+    weight: npt.NDArray[np.float64],
+    groups: int,
+    trim: float = DEFAULT_TRIM,
+) -> npt.NDArray[np.float64]:
+    """Median price of every group, 0 for empty groups."""
+    sorted_price = price[np.lexsort((price, group))]
+    counts = np.bincount(group, minlength=groups)
+    starts = np.cumsum(counts) - counts
+    medians = np.zeros(groups)
+    nonempty = counts > 0
+    low = (starts + (counts - 1) // 2)[nonempty]
+    high = (starts + counts // 2)[nonempty]
+    medians[nonempty] = (sorted_price[low] + sorted_price[high]) / 2
+    return medians
+
+
+def weighted_trimmed_mean(
+    group: npt.NDArray[np.intp],
+    price: npt.NDArray[np.int64],
+    weight: npt.NDArray[np.float64],
+    groups: int,
+    trim: float = DEFAULT_TRIM,
+) -> npt.NDArray[np.float64]:
+    """
+    Mean price of every group weighted by `weight`, after cutting `trim` of
+    the group's total weight off each end. Falls back to the weighted median
+    when nothing is left, and is 0 for empty groups.
+    """
+    order = np.lexsort((price, group))
+    group = group[order]
+    price = price[order]
+    weight = weight[order]
+    totals = np.bincount(group, weights=weight, minlength=groups)
+    # cumulative weight within each group, up to and including every price
+    cumulative = np.cumsum(weight)
+    cumulative -= (np.cumsum(totals) - totals)[group]
+    low = trim * totals[group]
+    high = totals[group] - low
+    # the part of every price's weight inside [low, high]
+    share = np.clip(
+        np.minimum(cumulative, high) - np.maximum(cumulative - weight, low), 0, None
+    )
+    kept = np.bincount(group, weights=share, minlength=groups)
+    sums = np.bincount(group, weights=share * price, minlength=groups)
+    means = np.divide(sums, kept, out=np.zeros(groups), where=kept > 0)
+    # weighted median: the first price reaching half the group's weight
+    reached = np.flatnonzero(cumulative >= totals[group] / 2)
+    median_groups, first = np.unique(group[reached], return_index=True)
+    fallback = np.zeros(groups)
+    fallback[median_groups] = price[reached[first]]
+    return np.where(kept > 0, means, fallback)
+
+
+AGGREGATIONS: dict[str, Aggregation] = {
+    "mean": group_mean,
+    "median": group_median,
+    "trimmed-mean": weighted_trimmed_mean,
+}
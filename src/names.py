@@ -0,0 +1,68 @@
+"""
+Memoised item name normalisation and the persisted unformatted name index
+"""
+
+import os
+import sys
+import json
+from typing import Any
+from spacecases_common import remove_skin_name_formatting as _unformat
+from constants import METADATA_FILES, OUTPUT_DIRECTORY
+from output import write_json
+
+NAME_INDEX_FILE = "name_index.json"
+
+# formatted name -> interned unformatted name
+_unformatted_names: dict[str, str] = {}
+
+
+def remove_skin_name_formatting(formatted_name: str) -> str:
+    """
+    `spacecases_common.remove_skin_name_formatting`, memoised. The results
+    are interned, so the many copies of a name share one string.
+    """
+    try:
+        return _unformatted_names[formatted_name]
+    except KeyError:
+        unformatted_name = sys.intern(_unformat(formatted_name))
+        _unformatted_names[formatted_name] = unformatted_name
+        return unformatted_name
+
+
+def clear_name_memo() -> None:
+    """Forget every memoised name, as if in a fresh process."""
+    _unformatted_names.clear()
+
+
+def load_name_index() -> dict[str, str]:
+    """
+    Load `name_index.json`, mapping unformatted names to formatted names, and
+    seed the memo with it. Returns an empty index if none was written yet.
+    """
+    try:
+        with open(
+            os.path.join(OUTPUT_DIRECTORY, NAME_INDEX_FILE), encoding="utf-8"
+        ) as f:
+            index: dict[str, str] = json.load(f)
+    except FileNotFoundError:
+        return {}
+    for unformatted_name, formatted_name in index.items():
+        _unformatted_names.setdefault(formatted_name, sys.intern(unformatted_name))
+    return index
+
+
+def write_name_index() -> None:
+    """
+    Write `name_index.json` from the metadata files in `OUTPUT_DIRECTORY`: the
+    formatted name of every item and container, by unformatted name.
+    """
+    index = {}
+    for file in METADATA_FILES:
+        try:
+            with open(os.path.join(OUTPUT_DIRECTORY, file), encoding="utf-8") as f:
+                metadata: dict[str, Any] = json.load(f)
+        except FileNotFoundError:
+            continue
+        for unformatted_name, datum in metadata.items():
+            index[unformatted_name] = datum["formatted_name"]
+    write_json(NAME_INDEX_FILE, dict(sorted(index.items())))
@@ -0,0 +1,66 @@
+"""
+Write generated metadata in readable, compact, pre-compressed and CBOR forms
+"""
+
+import os
+import gzip
+import json
+import cbor2
+import brotli  # type: ignore[import-untyped]
+from typing import Any
+from constants import OUTPUT_DIRECTORY
+from instrumentation import recorder
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """
+    Write `data` to a temporary file next to `path`, fsync it and rename it
+    into place, so readers never see a partially written file.
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    recorder.count("written_bytes", len(data))
+
+
+def write_precompressed(path: str, data: bytes) -> None:
+    """Write gzip and brotli compressed copies of `data` to `path`.gz/`path`.br."""
+    atomic_write(f"{path}.gz", gzip.compress(data, compresslevel=9, mtime=0))
+    atomic_write(f"{path}.br", brotli.compress(data, quality=11))
+
+
+def write_json(filename: str, data: Any, cbor: bool = False) -> None:
+    """
+    Write `data` to `filename` inside `OUTPUT_DIRECTORY`, along with
+
+    - `<name>.min.json`: the same document without whitespace
+    - `<name>.json.gz`/`<name>.json.br`: `<name>.json` exactly as written,
+      pre-compressed, for static servers that serve pre-compressed siblings
+    - `<name>.cbor` (if `cbor` is set): a CBOR encoding of the JSON document
+      using string references, so repeated names and URLs are only stored once
+    """
+    path = os.path.join(OUTPUT_DIRECTORY, filename)
+    stem, _ = os.path.splitext(path)
+    with recorder.span("write"), recorder.span(filename):
+        document = json.dumps(data, ensure_ascii=False, indent=4).encode()
+        atomic_write(path, document)
+        compact = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+        atomic_write(f"{stem}.min.json", compact)
+        with recorder.span("compress"):
+            write_precompressed(path, document)
+        if cbor:
+            # encode the document as written to JSON, so int keys become
+            # strings here too, however `data` was produced
+            atomic_write(
+                f"{stem}.cbor",
+                cbor2.dumps(json.loads(compact), string_referencing=True),
+            )
+
+
+def has_cbor(filename: str) -> bool:
+    """Whether a CBOR encoding was previously written for `filename`."""
+    stem, _ = os.path.splitext(os.path.join(OUTPUT_DIRECTORY, filename))
+    return os.path.exists(f"{stem}.cbor")
@@ -0,0 +1,242 @@
+"""
+Append-only price history with rolling aggregates
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import instrumentation
+import numpy as np
+import numpy.typing as npt
+from typing import Callable, NamedTuple, Optional
+from datetime import datetime, timezone
+from constants import HISTORY_DIRECTORY
+from output import atomic_write, write_json
+
+NAMES_FILE = "names.json"
+AGGREGATES_FILE = "price_aggregates.json"
+# rows are padded to a multiple of this so new items rarely start a new segment
+WIDTH_STEP = 1024
+# number of item columns aggregated at once, bounding memory use
+COLUMN_CHUNK = 1024
+WINDOWS = {
+    "24h": 24 * 60 * 60,
+    "7d": 7 * 24 * 60 * 60,
+    "30d": 30 * 24 * 60 * 60,
+}
+STATISTICS: dict[str, Callable[..., npt.NDArray[np.float64]]] = {
+    "mean": np.nanmean,
+    "median": np.nanmedian,
+    "min": np.nanmin,
+    "max": np.nanmax,
+}
+
+
+class Segment(NamedTuple):
+    """
+    One append-only segment: `<key>.ts` holds int64 snapshot timestamps and
+    `<key>.bin` one row of `width` int32 prices per snapshot, aligned with the
+    history's name table. A price of 0 means no price was available.
+
+    A snapshot only exists once its timestamp is written, so rows in `.bin`
+    past the number of timestamps, or all of them if there is no `.ts` yet,
+    are left over from an interrupted append and are ignored.
+    """
+
+    key: str
+    width: int
+
+    def paths(self, directory: str) -> tuple[str, str]:
+        base = os.path.join(directory, self.key)
+        return f"{base}.ts", f"{base}.bin"
+
+    def timestamps(self, directory: str) -> npt.NDArray[np.int64]:
+        """The committed snapshot timestamps, ignoring a partially written one."""
+        ts_path, _ = self.paths(directory)
+        try:
+            with open(ts_path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        return np.frombuffer(data, dtype="<i8", count=len(data) // 8)
+
+    def repair(self, directory: str) -> None:
+        """Drop whatever an interrupted append left past the last snapshot."""
+        ts_path, bin_path = self.paths(directory)
+        rows = os.path.getsize(ts_path) // 8 if os.path.exists(ts_path) else 0
+        for path, size in ((ts_path, rows * 8), (bin_path, rows * self.width * 4)):
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+
+
+class PriceHistory:
+    def __init__(self, directory: str = HISTORY_DIRECTORY) -> None:
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.names = self._load_names()
+        self.name_ids = {name: idx for idx, name in enumerate(self.names)}
+
+    def _load_names(self) -> list[str]:
+        try:
+            with open(os.path.join(self.directory, NAMES_FILE), encoding="utf-8") as f:
+                names: list[str] = json.load(f)
+        except FileNotFoundError:
+            return []
+        return names
+
+    def segments(self) -> list[Segment]:
+        """All segments, oldest first."""
+        # a segment whose first append was interrupted only has a `.bin`
+        keys = {
+            os.path.splitext(filename)[0]
+            for filename in os.listdir(self.directory)
+            if filename.endswith((".ts", ".bin"))
+        }
+        # keys are "<day>_<width>", sorting by key sorts by time
+        return [Segment(key, int(key.rsplit("_", 1)[1])) for key in sorted(keys)]
+
+    def append(self, prices: dict[str, int], timestamp: Optional[int] = None) -> None:
+        """Append a snapshot of `prices`, keyed by unformatted name."""
+        timestamp = int(time.time()) if timestamp is None else timestamp
+        new_names = [name for name in prices if name not in self.name_ids]
+        if new_names:
+            for name in new_names:
+                self.name_ids[name] = len(self.names)
+                self.names.append(name)
+            atomic_write(
+                os.path.join(self.directory, NAMES_FILE),
+                json.dumps(self.names, ensure_ascii=False).encode(),
+            )
+        day = datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y%m%d")
+        width = -(-len(self.names) // WIDTH_STEP) * WIDTH_STEP
+        # keep appending to today's segment while the rows still fit
+        for segment in reversed(self.segments()):
+            if segment.key.startswith(day) and segment.width >= len(self.names):
+                width = segment.width
+                break
+        segment = Segment(f"{day}_{width:08d}", width)
+        row = np.zeros(width, dtype="<i4")
+        ids = np.fromiter(
+            (self.name_ids[name] for name in prices), dtype=np.int64, count=len(prices)
+        )
+        row[ids] = np.fromiter(prices.values(), dtype=np.int64, count=len(prices))
+        ts_path, bin_path = segment.paths(self.directory)
+        segment.repair(self.directory)
+        # the timestamp commits the row, so it is only written once the row is
+        # on disk
+        with open(bin_path, "ab") as f:
+            f.write(row.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(ts_path, "ab") as f:
+            f.write(np.array([timestamp], dtype="<i8").tobytes())
+
+    def _window_segments(
+        self, since: int
+    ) -> list[tuple[Segment, npt.NDArray[np.int64], int]]:
+        """Segments with snapshots at or after `since`, and the first such row."""
+        selected = []
+        for segment in self.segments():
+            timestamps = segment.timestamps(self.directory)
+            if len(timestamps) == 0 or timestamps[-1] < since:
+                continue
+            first = int(np.searchsorted(timestamps, since))
+            selected.append((segment, timestamps, first))
+        return selected
+
+    def aggregates(
+        self, now: Optional[int] = None
+    ) -> dict[str, dict[str, list[Optional[int]]]]:
+        """
+        Rolling mean/median/min/max per item for each window in `WINDOWS`.
+
+        Segments are memory-mapped and aggregated `COLUMN_CHUNK` items at a
+        time, so only one chunk of the longest window is resident at once.
+        Items without a price in a window get `None`.
+        """
+        now = int(time.time()) if now is None else now
+        longest = max(WINDOWS.values())
+        segments = self._window_segments(now - longest)
+        timestamps = np.concatenate(
+            [ts[first:] for _, ts, first in segments] or [np.empty(0, dtype="<i8")]
+        )
+        window_starts = {
+            window: int(np.searchsorted(timestamps, now - length))
+            for window, length in WINDOWS.items()
+        }
+        results = {
+            window: {stat: np.full(len(self.names), np.nan) for stat in STATISTICS}
+            for window in WINDOWS
+        }
+        maps = [
+            (
+                np.memmap(
+                    segment.paths(self.directory)[1],
+                    dtype="<i4",
+                    mode="r",
+                    shape=(len(ts), segment.width),
+                )[first:],
+                segment.width,
+            )
+            for segment, ts, first in segments
+        ]
+        for start in range(0, len(self.names), COLUMN_CHUNK):
+            stop = min(start + COLUMN_CHUNK, len(self.names))
+            # older segments are narrower; items added later have no price there
+            chunk = np.full((len(timestamps), stop - start), np.nan)
+            row = 0
+            for rows, width in maps:
+                if start < width:
+                    chunk[row : row + len(rows), : min(stop, width) - start] = rows[
+                        :, start : min(stop, width)
+                    ]
+                row += len(rows)
+            chunk[chunk <= 0] = np.nan
+            for window, first_row in window_starts.items():
+                window_chunk = chunk[first_row:]
+                has_price = ~np.isnan(window_chunk).all(axis=0)
+                if not has_price.any():
+                    continue
+                values = window_chunk[:, has_price]
+                for stat, function in STATISTICS.items():
+                    results[window][stat][start:stop][has_price] = function(
+                        values, axis=0
+                    )
+        return {
+            window: {
+                stat: [None if np.isnan(v) else int(v) for v in values]
+                for stat, values in stats.items()
+            }
+            for window, stats in results.items()
+        }
+
+    def write_aggregates(self, now: Optional[int] = None) -> None:
+        """Write `price_aggregates.json` into `OUTPUT_DIRECTORY`."""
+        now = int(time.time()) if now is None else now
+        write_json(
+            AGGREGATES_FILE,
+            {
+                "updated_at": now,
+                "names": self.names,
+                "windows": self.aggregates(now),
+            },
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="price_history",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    instrumentation.configure(args)
+    PriceHistory().write_aggregates()
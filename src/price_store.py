@@ -0,0 +1,52 @@
+"""
+Compact price store kept separate from the static item metadata
+"""
+
+import os
+import sys
+import json
+from array import array
+from constants import OUTPUT_DIRECTORY
+from output import atomic_write, write_json, write_precompressed
+
+PRICE_NAMES_FILE = "price_names.json"
+PRICES_FILE = "prices.bin"
+
+
+def load_price_names() -> list[str]:
+    try:
+        with open(
+            os.path.join(OUTPUT_DIRECTORY, PRICE_NAMES_FILE), encoding="utf-8"
+        ) as f:
+            names: list[str] = json.load(f)
+    except FileNotFoundError:
+        return []
+    return names
+
+
+def write_price_store(prices: dict[str, int]) -> list[str]:
+    """
+    Write `prices`, keyed by unformatted name, as two columns:
+
+    - `price_names.json`: the item names. Existing names keep their position
+      and new ones are appended, so the file only changes when items are
+      added and a cached copy stays a valid prefix.
+    - `prices.bin`: a little-endian uint32 array of prices in cents, aligned
+      with `price_names.json`. Names without a price are 0.
+
+    Returns the names in store order.
+    """
+    names = load_price_names()
+    known = set(names)
+    new_names = [name for name in prices if name not in known]
+    if new_names:
+        names.extend(new_names)
+        write_json(PRICE_NAMES_FILE, names)
+    column = array("I", (prices.get(name, 0) for name in names))
+    assert column.itemsize == 4
+    if sys.byteorder == "big":
+        column.byteswap()
+    path = os.path.join(OUTPUT_DIRECTORY, PRICES_FILE)
+    atomic_write(path, column.tobytes())
+    write_precompressed(path, column.tobytes())
+    return names
@@ -1,117 +1,515 @@
 """
-Refresh prices in the `skin_metadata.json` and `sticker_metadata.json` files
+Refresh the prices of every item and container from the markets in
+`markets.MARKETS`, combining an item's listings on several markets with one
+of `markets.AGGREGATIONS`. Prices are written into the metadata files, only
+into those that changed along with `price_delta.json` (--delta), or into the
+separate price store (--price-store). Every refresh also rewrites the
+container values, and can append to the price history (--history). Runs
+once, or every --interval seconds with --daemon
 """
 
 import os
+import sys
 import json
-import requests
-import random
-from typing import Any
-from spacecases_common import remove_skin_name_formatting, PhaseGroup
-from constants import OUTPUT_DIRECTORY, VANILLA_KNIVES
-from decimal import Decimal
-from statistics import mean
-from util import Condition
-
-
-def fetch_skinport_data() -> Any:
-    """Fetch data from Skinport API or local cache."""
-    try:
-        with open("skinport_prices.json") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        with open("user_agents.txt") as f:
-            user_agents = [line.strip() for line in f.readlines()]
-        headers = {
-            "User-Agent": random.choice(user_agents),
-            "Accept-Encoding": "br, gzip, deflate",
-            "Accept": "*/*",
-            "Connection": "keep-alive",
-        }
-        response = requests.get(
-            "https://api.skinport.com/v1/items",
-            headers=headers,
-        )
-        response.raise_for_status()
-        skinport_item_data = response.json()
+import time
+import logging
+import argparse
+import fetch
+import instrumentation
+import numpy as np
+import numpy.typing as npt
+from typing import Any, Iterable, NamedTuple, Optional
+from spacecases_common import (
+    Container,
+    PhaseGroup,
+    SkinCase,
+    SouvenirPackage,
+    StickerCapsule,
+)
+from constants import (
+    METADATA_FILES,
+    OUTPUT_DIRECTORY,
+    VANILLA_KNIVES,
+)
+from output import write_json, has_cbor
+from instrumentation import recorder
+from price_store import write_price_store
+from price_history import PriceHistory
+from container_values import write_container_values
+from markets import (
+    AGGREGATIONS,
+    DEFAULT_TIMEOUT,
+    DEFAULT_TRIM,
+    MARKETS,
+    SKINPORT_TTL,
+    Market,
+    PriceFrame,
+    fetch_prices,
+)
 
-        # Optionally save fetched data for later use
-        with open("skinport_prices.json", "w") as f:
-            json.dump(skinport_item_data, f)
-        return skinport_item_data
 
+PRICE_DELTA_FILE = "price_delta.json"
 
-def aggregate_skinport_prices(
-    prices: dict[str, list[int]], skinport_item_data: Any
-) -> None:
-    """Aggregate prices from the Skinport data."""
-    for datum in skinport_item_data:
-        market_hash_name = datum["market_hash_name"]
-        if market_hash_name not in prices:
-            continue
-        price = datum["suggested_price"]
-        if price is None:
-            continue
-        price = int(Decimal(price) * 100)
+CONTAINER_MODELS: dict[str, type[Container]] = {
+    "skin_cases.json": SkinCase,
+    "souvenir_packages.json": SouvenirPackage,
+    "sticker_capsules.json": StickerCapsule,
+}
 
-        if market_hash_name in VANILLA_KNIVES:
-            for condition in Condition:
-                new_name = f"{market_hash_name} ({condition})"
-                prices[new_name].append(price)
-            continue
 
-        if "Gamma Doppler" in market_hash_name:
-            for phase in PhaseGroup.GAMMA_DOPPLER.get_phases():
-                new_name = market_hash_name.replace("(", f"- {phase} (")
-                if new_name not in prices:
-                    continue
-                prices[new_name].append(price)
-        elif "Doppler" in market_hash_name:
-            for phase in PhaseGroup.DOPPLER.get_phases():
-                new_name = market_hash_name.replace("(", f"- {phase} (")
-                if new_name not in prices:
-                    continue
-                prices[new_name].append(price)
+def get_skinport_name(formatted_name: str) -> str:
+    """Map a formatted item name to the Skinport listing that prices it."""
+    # vanilla knives are listed without a condition
+    name_no_wear, _, _ = formatted_name.rpartition(" (")
+    if name_no_wear in VANILLA_KNIVES:
+        return name_no_wear
+    # doppler phases share the listing of the doppler skin
+    if "Doppler" in formatted_name:
+        if "Gamma Doppler" in formatted_name:
+            phases = PhaseGroup.GAMMA_DOPPLER.get_phases()
         else:
-            prices[market_hash_name].append(price)
+            phases = PhaseGroup.DOPPLER.get_phases()
+        for phase in phases:
+            if f"- {phase} (" in formatted_name:
+                return formatted_name.replace(f"- {phase} (", "(")
+    return formatted_name
+
+
+def get_listing_names(metadata: dict[str, Any]) -> list[str]:
+    """The listing that prices every entry of a metadata file, in entry order."""
+    return [get_skinport_name(datum["formatted_name"]) for datum in metadata.values()]
+
+
+def get_listing_ids(
+    listing_names: list[str], frame: PriceFrame
+) -> npt.NDArray[np.intp]:
+    """
+    The name id in `frame` of every listing in `listing_names`, or -1 for
+    listings no market has.
+    """
+    name_ids = {name: name_id for name_id, name in enumerate(frame.names)}
+    return np.array([name_ids.get(name, -1) for name in listing_names], np.intp)
+
 
+def join_listings(
+    listing_ids: npt.NDArray[np.intp], frame: PriceFrame
+) -> tuple[npt.NDArray[np.intp], npt.NDArray[np.intp]]:
+    """
+    Expand every entry into the frame rows of its listing, on every market.
+    Knives and Doppler phases that share a listing each get its rows. Returns
+    the entry and the frame row of every pair, grouped by entry.
+    """
+    if not frame.names:
+        return np.empty(0, np.intp), np.empty(0, np.intp)
+    # the rows of every name id are contiguous in `order`
+    order = np.argsort(frame.name_id, kind="stable")
+    counts = np.bincount(frame.name_id, minlength=len(frame.names))
+    starts = np.cumsum(counts) - counts
+    listed = listing_ids >= 0
+    listing_ids = np.where(listed, listing_ids, 0)
+    entry_counts = np.where(listed, counts[listing_ids], 0)
+    entries = np.repeat(np.arange(len(listing_ids)), entry_counts)
+    # position of every pair within its entry's rows
+    offsets = np.arange(len(entries)) - np.repeat(
+        np.cumsum(entry_counts) - entry_counts, entry_counts
+    )
+    rows = order[np.repeat(starts[listing_ids], entry_counts) + offsets]
+    return entries, rows
 
-def aggregate_prices_for(file: str, skinport_item_data: Any) -> None:
-    """Process a single file and aggregate prices."""
-    with open(os.path.join(OUTPUT_DIRECTORY, file)) as f:
-        metadata = json.load(f)
 
-    # Initialize the price aggregation dictionary
-    prices: dict[str, list[int]] = {
-        datum["formatted_name"]: [] for datum in metadata.values()
+def load_metadata(file: str) -> dict[str, Any]:
+    with open(os.path.join(OUTPUT_DIRECTORY, file), encoding="utf-8") as f:
+        metadata: dict[str, Any] = json.load(f)
+    return metadata
+
+
+def compute_prices(
+    metadata: dict[str, dict[str, Any]],
+    frame: PriceFrame,
+    aggregation: str = "median",
+    trim: float = DEFAULT_TRIM,
+    listing_names: Optional[list[str]] = None,
+) -> dict[str, dict[str, int]]:
+    """
+    Combine the market prices of every entry in `metadata` with one of
+    `AGGREGATIONS`, by file. `listing_names` saves matching the entries to
+    their listings again, if already known.
+    """
+    if listing_names is None:
+        listing_names = [
+            name
+            for file_metadata in metadata.values()
+            for name in get_listing_names(file_metadata)
+        ]
+    listing_ids = get_listing_ids(listing_names, frame)
+    entries, rows = join_listings(listing_ids, frame)
+    aggregated = AGGREGATIONS[aggregation](
+        entries, frame.price[rows], frame.weight[rows], len(listing_ids), trim
+    )
+    entry_prices = map(int, aggregated)
+    return {
+        file: {key: next(entry_prices) for key in file_metadata}
+        for file, file_metadata in metadata.items()
     }
 
-    # Aggregate prices using Skinport data
-    aggregate_skinport_prices(prices, skinport_item_data)
 
-    # Calculate and assign mean prices to metadata
-    for name, aggregated_prices in prices.items():
-        unformatted_name = remove_skin_name_formatting(name)
-        if len(aggregated_prices) == 0:
-            price = 0
-        else:
-            mean_price = mean(aggregated_prices)
-            price = int(mean_price)
+def flatten_prices(prices: dict[str, dict[str, int]]) -> dict[str, int]:
+    return {
+        key: price
+        for file_prices in prices.values()
+        for key, price in file_prices.items()
+    }
+
+
+def apply_prices(
+    metadata: dict[str, dict[str, Any]],
+    prices: dict[str, dict[str, int]],
+    delta: bool = False,
+) -> dict[str, dict[str, int]]:
+    """
+    Assign `prices` to the metadata entries and write each file back.
+
+    In delta mode, files whose prices did not change are left untouched.
+    Returns the entries whose price changed, by file.
+    """
+    changes: dict[str, dict[str, int]] = {}
+    for file, file_metadata in metadata.items():
+        # Assign mean prices to metadata
+        file_changes = {}
+        for key, price in prices[file].items():
+            if file_metadata[key]["price"] != price:
+                file_changes[key] = price
+            file_metadata[key]["price"] = price
+
+        if file_changes:
+            changes[file] = file_changes
+        elif delta:
+            logging.info(f"No price changes in {file}, skipping")
+            continue
+
+        # Write updated metadata back to file
+        write_json(file, file_metadata, cbor=has_cbor(file))
+    return changes
+
+
+def reference_price_store(
+    metadata: dict[str, dict[str, Any]], names: list[str]
+) -> list[str]:
+    """
+    Point every metadata entry at its price in the price store: `price_index`
+    is its position in `price_names.json` and `prices.bin`. Positions never
+    change, so a file is only rewritten when it gains entries, and its `price`
+    is left as it was. Returns the files written.
+    """
+    positions = {name: position for position, name in enumerate(names)}
+    written = []
+    for file, file_metadata in metadata.items():
+        changed = False
+        for key, datum in file_metadata.items():
+            if datum.get("price_index") != positions[key]:
+                datum["price_index"] = positions[key]
+                changed = True
+        if changed:
+            write_json(file, file_metadata, cbor=has_cbor(file))
+            written.append(file)
+    return written
 
-        metadata[unformatted_name]["price"] = price
 
-    # Write updated metadata back to file
-    with open(os.path.join(OUTPUT_DIRECTORY, file), "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=4, ensure_ascii=False)
+class MetadataState:
+    """
+    The parsed metadata files and what is derived from them, kept between
+    refreshes. A file is only read again once its modification time or size
+    changes, and files written by a refresh are not read back.
+    """
+
+    def __init__(self) -> None:
+        self.metadata: dict[str, dict[str, Any]] = {}
+        self.listing_names: dict[str, list[str]] = {}
+        self.containers: dict[str, dict[str, Container]] = {}
+        self.stats: dict[str, tuple[int, int]] = {}
+        self.history: Optional[PriceHistory] = None
+
+    @staticmethod
+    def _stat(file: str) -> tuple[int, int]:
+        stat = os.stat(os.path.join(OUTPUT_DIRECTORY, file))
+        return stat.st_mtime_ns, stat.st_size
+
+    def reload(self) -> list[str]:
+        """Read the metadata files that changed on disk, returning which."""
+        reloaded = []
+        for file in METADATA_FILES:
+            stat = self._stat(file)
+            if self.stats.get(file) == stat:
+                continue
+            self.metadata[file] = load_metadata(file)
+            self.listing_names[file] = get_listing_names(self.metadata[file])
+            if file in CONTAINER_MODELS:
+                # Parse the loot tables once, they do not change with prices
+                self.containers[file] = {
+                    key: CONTAINER_MODELS[file].model_validate(datum)
+                    for key, datum in self.metadata[file].items()
+                }
+            self.stats[file] = stat
+            reloaded.append(file)
+        return reloaded
+
+    def mark_written(self, files: Iterable[str]) -> None:
+        """Record that the in-memory copies of `files` were just written out."""
+        for file in files:
+            self.stats[file] = self._stat(file)
+
+    def all_listing_names(self) -> list[str]:
+        return [name for file in self.metadata for name in self.listing_names[file]]
+
+    def all_containers(self) -> dict[str, Container]:
+        return {
+            key: container
+            for file_containers in self.containers.values()
+            for key, container in file_containers.items()
+        }
+
+    def price_history(self) -> PriceHistory:
+        if self.history is None:
+            self.history = PriceHistory()
+        return self.history
+
+
+def write_price_delta(changes: dict[str, dict[str, int]]) -> None:
+    """
+    Write `price_delta.json`: the new price of every entry that changed in
+    this refresh, by metadata file, for consumers to patch their copies with.
+
+    `sequence` is one more than that of the delta it replaces, and
+    `previous_updated_at` is that delta's `updated_at`, so a consumer that
+    missed a delta can tell and reload the metadata files instead.
+    """
+    try:
+        previous = load_metadata(PRICE_DELTA_FILE)
+    except (OSError, ValueError):
+        previous = {}
+    write_json(
+        PRICE_DELTA_FILE,
+        {
+            "sequence": previous.get("sequence", 0) + 1,
+            "previous_updated_at": previous.get("updated_at"),
+            "updated_at": int(time.time()),
+            "changes": changes,
+        },
+    )
+
+
+def refresh(
+    frame: PriceFrame,
+    price_store: bool = False,
+    delta: bool = False,
+    history: bool = False,
+    aggregation: str = "median",
+    trim: float = DEFAULT_TRIM,
+    state: Optional[MetadataState] = None,
+) -> None:
+    """
+    Price every metadata file from the prices in `frame` and write the
+    results. Pass the same `state` to every refresh of a long-running process
+    to keep the metadata in memory between them.
+
+    Raises without writing anything if `frame` has no listings, as when every
+    market failed before it ever returned prices, rather than pricing every
+    entry at 0.
+    """
+    if len(frame.price) == 0:
+        raise RuntimeError("No market returned any listings, leaving prices as is")
+    if state is None:
+        state = MetadataState()
+    with recorder.span("load"):
+        state.reload()
+    metadata = state.metadata
+    with recorder.span("aggregate"):
+        prices = compute_prices(
+            metadata, frame, aggregation, trim, state.all_listing_names()
+        )
+    if price_store:
+        names = write_price_store(flatten_prices(prices))
+        state.mark_written(reference_price_store(metadata, names))
+    else:
+        changes = apply_prices(metadata, prices, delta)
+        state.mark_written(changes if delta else metadata)
+        if delta:
+            write_price_delta(changes)
+    # Value every container's contents at the fresh prices
+    with recorder.span("container_values"):
+        write_container_values(state.all_containers(), flatten_prices(prices))
+    if history:
+        with recorder.span("history"):
+            price_history = state.price_history()
+            price_history.append(flatten_prices(prices))
+            price_history.write_aggregates()
+
+
+class CycleReport(NamedTuple):
+    cycle: int
+    fetch_seconds: float
+    reload_seconds: float
+    reloaded: list[str]
+    refresh_seconds: float
+
+    def log(self) -> None:
+        total = self.fetch_seconds + self.reload_seconds + self.refresh_seconds
+        logging.info(
+            f"Cycle {self.cycle} took {total:.3f} s: fetched prices in "
+            f"{self.fetch_seconds:.3f} s, reloaded {len(self.reloaded)} metadata "
+            f"files in {self.reload_seconds:.3f} s, priced and wrote them in "
+            f"{self.refresh_seconds:.3f} s"
+        )
+
+
+def run_daemon(
+    selected: list[Market],
+    interval: float,
+    price_store: bool = False,
+    delta: bool = False,
+    history: bool = False,
+    aggregation: str = "median",
+    trim: float = DEFAULT_TRIM,
+) -> None:
+    """
+    Refresh prices every `interval` seconds until interrupted, keeping the
+    metadata, the listing names and the HTTP session in memory. A failing
+    cycle, including one in which no market returned any listings, is logged
+    and skipped, and the next one runs on schedule.
+    """
+    state = MetadataState()
+    cycle = 0
+    while True:
+        cycle += 1
+        start = time.monotonic()
+        try:
+            frame = fetch_prices(selected)
+            fetched = time.monotonic()
+            reloaded = state.reload()
+            loaded = time.monotonic()
+            refresh(frame, price_store, delta, history, aggregation, trim, state=state)
+            CycleReport(
+                cycle,
+                fetched - start,
+                loaded - fetched,
+                reloaded,
+                time.monotonic() - loaded,
+            ).log()
+        except Exception:
+            logging.exception(f"Cycle {cycle} failed")
+        recorder.count("cycles")
+        instrumentation.save_report()
+        time.sleep(max(0.0, start + interval - time.monotonic()))
 
 
 if __name__ == "__main__":
-    # Fetch Skinport data once
-    skinport_data = fetch_skinport_data()
-
-    # Process files using the shared Skinport data
-    aggregate_prices_for("skin_metadata.json", skinport_data)
-    aggregate_prices_for("sticker_metadata.json", skinport_data)
-    aggregate_prices_for("skin_cases.json", skinport_data)
-    aggregate_prices_for("sticker_capsules.json", skinport_data)
-    aggregate_prices_for("souvenir_packages.json", skinport_data)
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        prog="refresh_prices",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--delta",
+        action="store_true",
+        help=f"only rewrite files whose prices changed and write {PRICE_DELTA_FILE}",
+    )
+    mode.add_argument(
+        "--price-store",
+        action="store_true",
+        help="write prices to the price store instead of the metadata files",
+    )
+    parser.add_argument(
+        "--history",
+        action="store_true",
+        help="append the prices to the price history and refresh its aggregates",
+    )
+    market_options = parser.add_argument_group("markets")
+    market_options.add_argument(
+        "-m",
+        "--market",
+        nargs="+",
+        choices=MARKETS,
+        default=list(MARKETS),
+        help="markets to fetch prices from",
+    )
+    market_options.add_argument(
+        "--stub",
+        action="append",
+        default=[],
+        metavar="MARKET=PATH",
+        help="read a market's listings from a local JSON file instead",
+    )
+    market_options.add_argument(
+        "--market-timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help="seconds to wait for a market before using its last prices",
+    )
+    market_options.add_argument(
+        "--aggregation",
+        choices=AGGREGATIONS,
+        default="median",
+        help="how the prices of an item on several markets are combined",
+    )
+    market_options.add_argument(
+        "--trim",
+        type=float,
+        default=DEFAULT_TRIM,
+        help="fraction of the weight cut off each end by the trimmed mean",
+    )
+    daemon = parser.add_argument_group("daemon")
+    daemon.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running, refreshing prices every --interval seconds",
+    )
+    daemon.add_argument(
+        "--interval",
+        type=float,
+        default=SKINPORT_TTL,
+        help="seconds between the starts of two refreshes in daemon mode",
+    )
+    fetch.add_arguments(parser)
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    fetch.configure(args)
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+    )
+    instrumentation.configure(args)
+    if not 0 <= args.trim < 0.5:
+        parser.error("--trim must be at least 0 and less than 0.5")
+    for stub in args.stub:
+        name, separator, path = stub.partition("=")
+        if not separator or name not in MARKETS:
+            parser.error(f"invalid --stub {stub}, expected MARKET=PATH")
+        MARKETS[name].stub = path
+    selected = [MARKETS[name] for name in args.market]
+    for market in selected:
+        market.timeout = args.market_timeout
+    if args.daemon:
+        try:
+            run_daemon(
+                selected,
+                args.interval,
+                args.price_store,
+                args.delta,
+                args.history,
+                args.aggregation,
+                args.trim,
+            )
+        except KeyboardInterrupt:
+            logging.info("Stopping")
+        sys.exit(0)
+    # Fetch every market concurrently and price every file in one pass
+    refresh(
+        fetch_prices(selected),
+        args.price_store,
+        args.delta,
+        args.history,
+        args.aggregation,
+        args.trim,
+    )
@@ -0,0 +1,202 @@
+"""
+Precomputed, vectorised loot-table sampling index for containers
+"""
+
+import io
+import os
+import numpy as np
+import numpy.typing as npt
+from typing import Mapping, NamedTuple, Sequence
+from spacecases_common import (
+    Container,
+    ContainerEntry,
+    PhaseGroup,
+    Rarity,
+    SkinContainerEntry,
+)
+from constants import OUTPUT_DIRECTORY, RARITY_WEIGHTS, RARE_SPECIAL_WEIGHT
+from output import atomic_write
+
+SAMPLING_INDEX_FILE = "container_sampling.npz"
+# tier "rarity" used for the rare special items (knives and gloves)
+RARE_SPECIAL_TIER = len(Rarity)
+NO_PHASE_GROUP = -1
+PHASE_COUNTS = np.array([len(group.get_phases()) for group in PhaseGroup])
+
+
+def build_alias_table(
+    weights: Sequence[float],
+) -> tuple[npt.NDArray[np.float64], npt.NDArray[np.int32]]:
+    """
+    Build a Vose alias table for `weights`, so that an index can be drawn
+    with one uniform column pick and one biased coin flip.
+    """
+    n = len(weights)
+    scaled = np.asarray(weights, dtype=np.float64) * n / sum(weights)
+    prob = np.ones(n, dtype=np.float64)
+    alias = np.arange(n, dtype=np.int32)
+    small = [i for i in range(n) if scaled[i] < 1.0]
+    large = [i for i in range(n) if scaled[i] >= 1.0]
+    while small and large:
+        less, more = small.pop(), large.pop()
+        prob[less] = scaled[less]
+        alias[less] = more
+        scaled[more] -= 1.0 - scaled[less]
+        (small if scaled[more] < 1.0 else large).append(more)
+    return prob, alias
+
+
+class Openings(NamedTuple):
+    """Outcome of a batch of openings; `phase` is -1 for items without phases."""
+
+    name_id: npt.NDArray[np.int32]
+    floats: npt.NDArray[np.float64]
+    phase: npt.NDArray[np.int8]
+
+
+class SamplingIndex(NamedTuple):
+    """
+    Flat arrays describing every container's loot table.
+
+    Container `c` owns tiers `container_tier_start[c]:container_tier_start[c + 1]`
+    and tier `t` owns entries `tier_entry_start[t]:tier_entry_start[t + 1]`.
+    `tier_threshold` holds each container's cumulative tier probabilities and
+    `alias_prob`/`alias_index` one alias table per tier, with indices local
+    to the tier. Entries without a float range have NaN floats.
+    """
+
+    containers: npt.NDArray[np.str_]
+    names: npt.NDArray[np.str_]
+    container_tier_start: npt.NDArray[np.int32]
+    tier_rarity: npt.NDArray[np.int8]
+    tier_threshold: npt.NDArray[np.float64]
+    tier_entry_start: npt.NDArray[np.int32]
+    alias_prob: npt.NDArray[np.float64]
+    alias_index: npt.NDArray[np.int32]
+    entry_name_id: npt.NDArray[np.int32]
+    min_float: npt.NDArray[np.float64]
+    max_float: npt.NDArray[np.float64]
+    phase_group: npt.NDArray[np.int8]
+
+    @classmethod
+    def build(cls, containers: Mapping[str, Container]) -> "SamplingIndex":
+        names: dict[str, int] = {}
+        container_tier_start = [0]
+        tier_rarity: list[int] = []
+        tier_threshold: list[float] = []
+        tier_entry_start = [0]
+        alias_prob: list[npt.NDArray[np.float64]] = []
+        alias_index: list[npt.NDArray[np.int32]] = []
+        entry_name_id: list[int] = []
+        min_float: list[float] = []
+        max_float: list[float] = []
+        phase_group: list[int] = []
+        for container in containers.values():
+            contains: dict[Rarity, Sequence[ContainerEntry]] = dict(container.contains)
+            tiers = [
+                (int(rarity), RARITY_WEIGHTS[rarity], entries)
+                for rarity, entries in sorted(contains.items())
+                if entries
+            ]
+            rare: Sequence[ContainerEntry] = container.contains_rare
+            if rare:
+                tiers.append((RARE_SPECIAL_TIER, RARE_SPECIAL_WEIGHT, rare))
+            total = sum(weight for _, weight, _ in tiers)
+            cumulative = 0.0
+            for rarity, weight, entries in tiers:
+                cumulative += weight / total
+                tier_rarity.append(rarity)
+                tier_threshold.append(cumulative)
+                # items within a tier are equally likely
+                prob, alias = build_alias_table([1.0] * len(entries))
+                alias_prob.append(prob)
+                alias_index.append(alias)
+                for entry in entries:
+                    entry_name_id.append(
+                        names.setdefault(entry.unformatted_name, len(names))
+                    )
+                    if isinstance(entry, SkinContainerEntry):
+                        min_float.append(entry.min_float)
+                        max_float.append(entry.max_float)
+                        phase_group.append(
+                            NO_PHASE_GROUP
+                            if entry.phase_group is None
+                            else int(entry.phase_group)
+                        )
+                    else:
+                        min_float.append(np.nan)
+                        max_float.append(np.nan)
+                        phase_group.append(NO_PHASE_GROUP)
+                tier_entry_start.append(len(entry_name_id))
+            # guard against the cumulative sum falling short of 1 through rounding
+            if tiers:
+                tier_threshold[-1] = 1.0
+            container_tier_start.append(len(tier_rarity))
+        return cls(
+            containers=np.array(list(containers), dtype=np.str_),
+            names=np.array(list(names), dtype=np.str_),
+            container_tier_start=np.array(container_tier_start, dtype=np.int32),
+            tier_rarity=np.array(tier_rarity, dtype=np.int8),
+            tier_threshold=np.array(tier_threshold, dtype=np.float64),
+            tier_entry_start=np.array(tier_entry_start, dtype=np.int32),
+            alias_prob=np.concatenate(alias_prob or [np.empty(0)]),
+            alias_index=np.concatenate(
+                alias_index or [np.empty(0, dtype=np.int32)]
+            ).astype(np.int32),
+            entry_name_id=np.array(entry_name_id, dtype=np.int32),
+            min_float=np.array(min_float, dtype=np.float64),
+            max_float=np.array(max_float, dtype=np.float64),
+            phase_group=np.array(phase_group, dtype=np.int8),
+        )
+
+    def save(
+        self, path: str = os.path.join(OUTPUT_DIRECTORY, SAMPLING_INDEX_FILE)
+    ) -> None:
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, **self._asdict())
+        atomic_write(path, buffer.getvalue())
+
+    @classmethod
+    def load(
+        cls, path: str = os.path.join(OUTPUT_DIRECTORY, SAMPLING_INDEX_FILE)
+    ) -> "SamplingIndex":
+        with np.load(path) as data:
+            return cls(**{field: data[field] for field in cls._fields})
+
+    def container_id(self, unformatted_name: str) -> int:
+        matches = np.flatnonzero(self.containers == unformatted_name)
+        if len(matches) == 0:
+            raise KeyError(unformatted_name)
+        return int(matches[0])
+
+    def sample(self, container_id: int, n: int, rng: np.random.Generator) -> Openings:
+        """Draw `n` openings of the container `container_id` in one batch."""
+        first_tier = self.container_tier_start[container_id]
+        last_tier = self.container_tier_start[container_id + 1]
+        if first_tier == last_tier:
+            raise ValueError(f"{self.containers[container_id]} has no items")
+        # rarity tier
+        thresholds = self.tier_threshold[first_tier:last_tier]
+        tier = first_tier + np.minimum(
+            np.searchsorted(thresholds, rng.random(n), side="right"),
+            last_tier - first_tier - 1,
+        )
+        # entry within the tier, through its alias table
+        start = self.tier_entry_start[tier]
+        size = self.tier_entry_start[tier + 1] - start
+        column = start + (rng.random(n) * size).astype(np.int32)
+        entry = np.where(
+            rng.random(n) < self.alias_prob[column],
+            column,
+            start + self.alias_index[column],
+        )
+        # float and phase
+        low = self.min_float[entry]
+        floats = low + rng.random(n) * (self.max_float[entry] - low)
+        groups = self.phase_group[entry]
+        has_phase = groups != NO_PHASE_GROUP
+        phases = np.full(n, -1, dtype=np.int8)
+        phases[has_phase] = (
+            rng.random(int(has_phase.sum())) * PHASE_COUNTS[groups[has_phase]]
+        ).astype(np.int8)
+        return Openings(self.entry_name_id[entry], floats, phases)
@@ -0,0 +1,390 @@
+"""
+Serve the generated assets over HTTP with caching headers, pre-compressed
+variants and range requests
+"""
+
+import os
+import re
+import sys
+import logging
+import argparse
+import instrumentation
+import mimetypes
+import threading
+from typing import BinaryIO, NamedTuple, Optional
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+from constants import OUTPUT_DIRECTORY
+from dedup import BLOB_DIRECTORY
+from aliases import ALIAS_INDEX_FILE, AliasIndex
+from instrumentation import recorder
+
+ASSET_DIRECTORY = os.path.dirname(OUTPUT_DIRECTORY)
+# blobs are named by their content, so they never change
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+IMAGE_CACHE_CONTROL = "public, max-age=86400"
+# prices change with every refresh
+DATA_CACHE_CONTROL = "public, max-age=60"
+# pre-compressed siblings, in order of preference
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+CONTENT_TYPES = {
+    ".json": "application/json",
+    ".webp": "image/webp",
+    ".avif": "image/avif",
+    ".cbor": "application/cbor",
+    ".bin": "application/octet-stream",
+    ".pack": "application/octet-stream",
+    ".npz": "application/octet-stream",
+}
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+
+class Asset(NamedTuple):
+    """
+    A servable file and how it is served, worked out once. The file is
+    opened through `path`, so relinked symlinks are followed, and a changed
+    `inode` shows the file was replaced and its headers need working out again.
+    """
+
+    path: str
+    inode: int
+    content_type: str
+    cache_control: str
+    # content coding -> pre-compressed sibling
+    encodings: dict[str, str]
+    # the sha256 of content-addressed files
+    digest: Optional[str]
+
+
+def content_type(path: str) -> str:
+    extension = os.path.splitext(path)[1]
+    if extension in CONTENT_TYPES:
+        return CONTENT_TYPES[extension]
+    guessed, _ = mimetypes.guess_type(path)
+    return guessed or "application/octet-stream"
+
+
+def create_asset(path: str, blob_directory: str, alias: bool = False) -> Asset:
+    """
+    Resolve the symlinks of `path` and pick how it is served. An `alias`
+    serves `path` under another name, which can be pointed elsewhere.
+    """
+    target = os.path.realpath(path)
+    digest = None
+    if os.path.dirname(target) == blob_directory:
+        # names linking to a blob can be relinked, only the blob's own URL
+        # is immutable, but the blob's name always makes a strong ETag
+        digest = os.path.splitext(os.path.basename(target))[0]
+    if not alias and os.path.realpath(os.path.dirname(path)) == blob_directory:
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    elif content_type(target).startswith("image/"):
+        cache_control = IMAGE_CACHE_CONTROL
+    else:
+        cache_control = DATA_CACHE_CONTROL
+    encodings = {
+        coding: f"{path}{suffix}"
+        for coding, suffix in ENCODINGS
+        if os.path.isfile(f"{path}{suffix}")
+    }
+    return Asset(
+        path,
+        os.stat(target).st_ino,
+        content_type(target),
+        cache_control,
+        encodings,
+        digest,
+    )
+
+
+class AssetIndex:
+    """
+    Every servable file by URL path, resolved once. Files added after the
+    index was built are resolved on their first request, and files replaced
+    since are resolved again. Names in the image alias index are served from
+    the files they resolve to, as if they were symlinks.
+    """
+
+    def __init__(self, directory: str = ASSET_DIRECTORY) -> None:
+        self.directory = os.path.abspath(directory)
+        self.blob_directory = os.path.realpath(
+            os.path.join(
+                self.directory, os.path.relpath(BLOB_DIRECTORY, ASSET_DIRECTORY)
+            )
+        )
+        self.output_directory = os.path.join(
+            self.directory, os.path.relpath(OUTPUT_DIRECTORY, ASSET_DIRECTORY)
+        )
+        self.assets: dict[str, Asset] = {}
+        # URL path -> file of every alias, reloaded when the index is rewritten
+        self.aliases: dict[str, str] = {}
+        self.aliases_mtime: Optional[int] = None
+        self.lock = threading.Lock()
+        self.load_aliases()
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                if filename.endswith(".tmp") or not os.path.isfile(path):
+                    continue
+                self.assets[self.url_path(path)] = create_asset(
+                    path, self.blob_directory
+                )
+        for url_path, path in self.aliases.items():
+            if os.path.isfile(path):
+                self.assets[url_path] = create_asset(
+                    path, self.blob_directory, alias=True
+                )
+        logging.info(f"Indexed {len(self.assets)} files in {self.directory}")
+
+    def url_path(self, path: str) -> str:
+        return "/" + os.path.relpath(path, self.directory).replace(os.sep, "/")
+
+    def load_aliases(self) -> None:
+        """Read the alias index again if it changed since it was last read."""
+        try:
+            mtime = os.stat(
+                os.path.join(self.output_directory, ALIAS_INDEX_FILE)
+            ).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self.aliases_mtime:
+            return
+        index = AliasIndex.load(self.output_directory)
+        self.aliases = {
+            self.url_path(os.path.join(self.output_directory, path)): os.path.join(
+                self.output_directory, source
+            )
+            for path, source in index.paths()
+        }
+        self.aliases_mtime = mtime
+
+    def get(self, url_path: str, refresh: bool = False) -> Optional[Asset]:
+        """
+        The asset at `url_path`, or `None` if there is none. Assets are cached
+        by their normalised path, so different spellings of one path share an
+        entry, and misses are not cached.
+        """
+        path = os.path.normpath(os.path.join(self.directory, url_path.lstrip("/")))
+        # refuse anything outside the asset directory
+        if os.path.commonpath([path, self.directory]) != self.directory:
+            return None
+        url_path = self.url_path(path)
+        if refresh:
+            with self.lock:
+                self.assets.pop(url_path, None)
+        asset = self.assets.get(url_path)
+        if asset is not None:
+            return asset
+        alias = not os.path.isfile(path)
+        if alias:
+            with self.lock:
+                self.load_aliases()
+            if url_path not in self.aliases:
+                return None
+            path = self.aliases[url_path]
+        try:
+            asset = create_asset(path, self.blob_directory, alias)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.assets[url_path] = asset
+        return asset
+
+
+def parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """
+    The inclusive `(first, last)` byte positions of a single `bytes=` range,
+    or `None` if it cannot be satisfied.
+    """
+    match = RANGE_PATTERN.fullmatch(header.strip())
+    if match is None:
+        return None
+    first, last = match.groups()
+    if not first:
+        if not last or int(last) == 0:
+            return None
+        # suffix range: the last `last` bytes
+        return max(0, size - int(last)), size - 1
+    if int(first) >= size:
+        return None
+    if not last:
+        return int(first), size - 1
+    if int(last) < int(first):
+        return None
+    return int(first), min(int(last), size - 1)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    """
+    Whether the `If-None-Match` header `header` matches `etag`. As this is a
+    weak comparison, `W/` prefixes are ignored, and `*` matches any ETag.
+    """
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class AssetHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    index: AssetIndex
+
+    def log_message(self, format: str, *args: object) -> None:
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def send_response(self, code: int, message: Optional[str] = None) -> None:
+        recorder.count("served_requests", status=str(int(code)))
+        super().send_response(code, message)
+
+    def do_HEAD(self) -> None:
+        with recorder.span("request"):
+            self.serve(send_body=False)
+
+    def do_GET(self) -> None:
+        with recorder.span("request"):
+            self.serve(send_body=True)
+
+    def accepted_encodings(self) -> set[str]:
+        accepted = set()
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, parameters = coding.strip().partition(";")
+            if parameters.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00"):
+                accepted.add(name.strip().lower())
+        return accepted
+
+    def send_empty(self, status: HTTPStatus) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def open_asset(
+        self, url_path: str
+    ) -> Optional[tuple[Asset, Optional[str], BinaryIO]]:
+        """
+        The asset at `url_path`, the content coding to send it in and the
+        open file to send, resolving the path again if the file was removed
+        or replaced since it was indexed.
+        """
+        accepted = self.accepted_encodings()
+        for refresh in (False, True):
+            asset = self.index.get(url_path, refresh)
+            if asset is None:
+                return None
+            encoding = next(
+                (coding for coding in asset.encodings if coding in accepted), None
+            )
+            path = asset.path if encoding is None else asset.encodings[encoding]
+            try:
+                f = open(path, "rb")
+            except FileNotFoundError:
+                continue
+            replaced = os.fstat(f.fileno()).st_ino != asset.inode
+            if encoding is None and replaced and not refresh:
+                f.close()
+                continue
+            return asset, encoding, f
+        return None
+
+    def serve(self, send_body: bool) -> None:
+        url_path = unquote(urlsplit(self.path).path)
+        opened = self.open_asset(url_path)
+        if opened is None:
+            self.send_empty(HTTPStatus.NOT_FOUND)
+            return
+        asset, encoding, f = opened
+        with f:
+            # stat the open file, so the headers match the bytes sent even
+            # if the file is replaced meanwhile
+            stat = os.fstat(f.fileno())
+            if asset.digest is not None:
+                tag = asset.digest
+            else:
+                tag = f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+            etag = f'"{tag}"' if encoding is None else f'"{tag}-{encoding}"'
+            if etag_matches(self.headers.get("If-None-Match", ""), etag):
+                self.send_response(HTTPStatus.NOT_MODIFIED)
+                self.send_header("ETag", etag)
+                self.send_header("Cache-Control", asset.cache_control)
+                self.end_headers()
+                return
+            first, last = 0, stat.st_size - 1
+            status = HTTPStatus.OK
+            range_header = self.headers.get("Range")
+            if (
+                range_header is not None
+                and encoding is None
+                and self.headers.get("If-Range", etag) == etag
+            ):
+                byte_range = parse_range(range_header, stat.st_size)
+                if byte_range is None:
+                    self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+                    self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                first, last = byte_range
+                status = HTTPStatus.PARTIAL_CONTENT
+            self.send_response(status)
+            self.send_header("Content-Type", asset.content_type)
+            self.send_header("Content-Length", str(last - first + 1))
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", asset.cache_control)
+            self.send_header("Accept-Ranges", "bytes")
+            if asset.encodings:
+                self.send_header("Vary", "Accept-Encoding")
+            if encoding is not None:
+                self.send_header("Content-Encoding", encoding)
+            if status == HTTPStatus.PARTIAL_CONTENT:
+                self.send_header(
+                    "Content-Range", f"bytes {first}-{last}/{stat.st_size}"
+                )
+            self.end_headers()
+            if send_body and last >= first:
+                self.wfile.flush()
+                # zero-copy from the page cache where the platform allows
+                self.connection.sendfile(f, first, last - first + 1)
+                recorder.count("served_bytes", last - first + 1)
+
+
+def create_server(host: str, port: int, directory: str) -> ThreadingHTTPServer:
+    handler = type("Handler", (AssetHandler,), {"index": AssetIndex(directory)})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    # argument parsing
+    parser = argparse.ArgumentParser(
+        prog="serve",
+        description=sys.modules[__name__].__doc__,
+        epilog="Report bugs to https://github.com/SpaceCases/Assets/issues",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address to listen on, 0.0.0.0 to listen on every interface",
+    )
+    parser.add_argument(
+        "-p", "--port", type=int, default=8000, help="port to listen on"
+    )
+    parser.add_argument(
+        "--directory", default=ASSET_DIRECTORY, help="directory to serve"
+    )
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help="log every request"
+    )
+    instrumentation.add_arguments(parser)
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    instrumentation.configure(args)
+    server = create_server(args.host, args.port, args.directory)
+    logging.info(f"Serving {args.directory} on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping")
+    server.server_close()
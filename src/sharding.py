@@ -0,0 +1,55 @@
+"""
+Split upstream records into shards and process them on a process pool
+"""
+
+import multiprocessing
+from collections import deque
+from itertools import islice
+from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar
+from concurrent.futures import Future, ProcessPoolExecutor
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+SHARD_SIZE = 512
+# shards submitted ahead of the one being yielded, per job
+SHARDS_IN_FLIGHT_PER_JOB = 2
+
+
+def chunked(records: Iterable[T], size: int) -> Iterator[list[T]]:
+    iterator = iter(records)
+    while shard := list(islice(iterator, size)):
+        yield shard
+
+
+def map_shards(
+    function: Callable[[list[T]], R],
+    records: Iterable[T],
+    jobs: int,
+    shard_size: int = SHARD_SIZE,
+    initializer: Optional[Callable[..., None]] = None,
+    initargs: tuple[Any, ...] = (),
+) -> Iterator[R]:
+    """
+    Apply `function` to consecutive shards of `records`, yielding the results
+    in shard order. With more than one job the shards are processed on a
+    process pool, whose workers run `initializer(*initargs)` first. Only a
+    few shards per job are read ahead of the consumer, so memory use does not
+    grow with the number of records.
+    """
+    if jobs <= 1:
+        yield from map(function, chunked(records, shard_size))
+        return
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initializer,
+        initargs=initargs,
+    ) as executor:
+        pending: deque[Future[R]] = deque()
+        for shard in chunked(records, shard_size):
+            if len(pending) >= jobs * SHARDS_IN_FLIGHT_PER_JOB:
+                yield pending.popleft().result()
+            pending.append(executor.submit(function, shard))
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,133 @@
+"""
+Incremental parsing of large top-level JSON arrays and objects
+"""
+
+import json
+from typing import Any, Iterable, Iterator
+from fetch import upstream
+from instrumentation import recorder
+
+CHUNK_SIZE = 64 * 1024
+# drop consumed text from the buffer once this many characters have been parsed
+COMPACT_THRESHOLD = 1024 * 1024
+WHITESPACE = " \t\n\r"
+NUMBER_CHARACTERS = "0123456789+-.eE"
+
+
+class _Reader:
+    """Character buffer over a stream of text chunks, refilled on demand."""
+
+    def __init__(self, chunks: Iterable[str]) -> None:
+        self.chunks = iter(chunks)
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        if self.eof:
+            return False
+        if self.pos > COMPACT_THRESHOLD:
+            self.buffer = self.buffer[self.pos :]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer += chunk
+                return True
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON document")
+
+    def expect(self, characters: str) -> str:
+        character = self.peek()
+        if character not in characters:
+            raise ValueError(
+                f"Expected one of {characters!r} at offset {self.pos}, got {character!r}"
+            )
+        self.pos += 1
+        return character
+
+    def finish(self) -> None:
+        """Consume the rest of the stream, which must only be whitespace."""
+        while True:
+            if self.buffer[self.pos :].strip(WHITESPACE):
+                raise ValueError(f"Unexpected data after JSON document at {self.pos}")
+            self.pos = len(self.buffer)
+            if not self._fill():
+                return
+
+    def value(self) -> Any:
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number is only complete once a delimiter follows it
+            if (
+                isinstance(value, (int, float))
+                and not self.buffer[end:].strip(NUMBER_CHARACTERS)
+                and self._fill()
+            ):
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_array(chunks: Iterable[str]) -> Iterator[Any]:
+    """Yield each element of a top-level JSON array as soon as it is parsed."""
+    reader = _Reader(chunks)
+    reader.expect("[")
+    if reader.peek() == "]":
+        reader.pos += 1
+    else:
+        while True:
+            with recorder.span("parse"):
+                value = reader.value()
+            yield value
+            if reader.expect(",]") == "]":
+                break
+    reader.finish()
+
+
+def iter_json_object(chunks: Iterable[str]) -> Iterator[tuple[str, Any]]:
+    """Yield each key/value pair of a top-level JSON object as soon as it is parsed."""
+    reader = _Reader(chunks)
+    reader.expect("{")
+    if reader.peek() == "}":
+        reader.pos += 1
+    else:
+        while True:
+            with recorder.span("parse"):
+                key = reader.value()
+                reader.expect(":")
+                value = reader.value()
+            yield key, value
+            if reader.expect(",}") == "}":
+                break
+    reader.finish()
+
+
+def stream_file(path: str) -> Iterator[str]:
+    with open(path, encoding="utf-8") as f:
+        while chunk := f.read(CHUNK_SIZE):
+            yield chunk
+
+
+def stream_document(source: str) -> Iterator[str]:
+    """Stream a JSON document from a URL (through the upstream cache) or a file."""
+    if source.startswith(("http://", "https://")):
+        return recorder.iterate("fetch", upstream.stream(source))
+    return recorder.iterate("read", stream_file(source))
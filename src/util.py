@@ -1,11 +1,16 @@
 import os
+from typing import Optional
 from spacecases_common import Rarity, Condition
+from aliases import AliasIndex
+from image_pipeline import image_path
+
+_CONDITION_MIN_FLOATS = [0.0, 0.07, 0.15, 0.38, 0.45]
 
 
 def _get_best_condition_idx(min_float: float) -> int:
     if min_float > 1.0:
         raise ValueError("min_float must be <= 1.0")
-    for idx, min in reversed(list(enumerate([0.0, 0.07, 0.15, 0.38, 0.45]))):
+    for idx, min in reversed(list(enumerate(_CONDITION_MIN_FLOATS))):
         if min_float >= min:
             return idx
     raise ValueError(
@@ -18,7 +23,7 @@ def _get_worst_condition_idx(max_float: float) -> int:
         return 0
     if max_float > 1.0:
         raise ValueError("max_float must be <= 1.0")
-    for idx, min in reversed(list(enumerate([0.0, 0.07, 0.15, 0.38, 0.45]))):
+    for idx, min in reversed(list(enumerate(_CONDITION_MIN_FLOATS))):
         if max_float > min:
             return idx
     raise ValueError(
@@ -36,14 +41,36 @@ def get_all_conditions_for_float_range(
     return [Condition(i) for i in range(min_idx, max_idx + 1)]
 
 
-def create_image_url(name: str, asset_domain: str) -> str:
-    return os.path.join(
-        asset_domain,
-        "generated",
-        "images",
-        "unformatted",
-        f"{name}.png",
-    )
+def get_condition_float_range(condition: Condition) -> tuple[float, float]:
+    min_float = _CONDITION_MIN_FLOATS[condition]
+    if condition == len(_CONDITION_MIN_FLOATS) - 1:
+        return min_float, 1.0
+    return min_float, _CONDITION_MIN_FLOATS[condition + 1]
+
+
+def create_image_url(
+    name: str,
+    asset_domain: str,
+    size: Optional[int] = None,
+    image_format: str = "png",
+    directory: str = "unformatted",
+    aliases: Optional[AliasIndex] = None,
+) -> str:
+    """
+    URL of the image of `name` in `images/<directory>`. PNG images are only
+    available at full size; WebP (and AVIF, where generated) variants are
+    available at the sizes in `image_pipeline.VARIANT_SIZES`, `None` being
+    the full size. With `aliases`, names it knows point straight at the file
+    holding the image rather than at a symlink.
+    """
+    if image_format == "png" and size is not None:
+        raise ValueError("PNG images are only available at full size")
+    path = None
+    if aliases is not None:
+        path = aliases.resolve(name, directory, size, image_format)
+    if path is None:
+        path = image_path(directory, name, size, image_format)
+    return os.path.join(asset_domain, "generated", path)
 
 
 def get_rarity_from_string(string: str) -> Rarity: